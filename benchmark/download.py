@@ -0,0 +1,314 @@
+import hashlib
+import http.client
+import io
+import json
+import tarfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+CHUNK_SIZE = 32 << 20
+READ_SIZE = 1 << 20
+RETRIES = 5
+
+
+class DownloadError(Exception):
+    pass
+
+
+def remote_size(url, timeout=60):
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        size = response.headers.get("Content-Length")
+        ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(size) if size is not None else None), ranges
+
+
+def parse_checksum(checksum):
+    algorithm, _, digest = checksum.partition(":")
+    if not digest:
+        raise ValueError(f"checksum must look like sha256:<hex>, got {checksum!r}")
+    hashlib.new(algorithm)
+    return algorithm, digest.lower()
+
+
+class RangedDownload:
+    """Download ``url`` to ``dest`` over several ranged connections.
+
+    Completed chunks are recorded in ``<dest>.state`` so an interrupted
+    download resumes where it stopped. ``open`` returns a sequential reader
+    over the partial file that blocks until the requested bytes have arrived,
+    which lets the archive be extracted while it is still downloading.
+    """
+
+    def __init__(
+        self,
+        url,
+        dest,
+        connections=8,
+        chunk_size=CHUNK_SIZE,
+        checksum=None,
+        retries=RETRIES,
+        timeout=60,
+        progress=None,
+    ):
+        self.url = url
+        self.dest = Path(dest)
+        self.part = self.dest.with_name(self.dest.name + ".part")
+        self.state_file = self.dest.with_name(self.dest.name + ".state")
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.checksum = parse_checksum(checksum) if checksum else None
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.size = None
+        self.ranged = False
+        self.chunks = []
+        self._written = []
+        self._done = set()
+        self._error = None
+        self._cancelled = False
+        self._finished = False
+        self._digest = None
+        self._cond = threading.Condition()
+        self._executor = None
+        self._futures = []
+
+    def start(self):
+        if self.dest.exists() and not self.state_file.exists():
+            self.size = self.dest.stat().st_size
+            self.chunks = [(0, self.size)]
+            self._written = [self.size]
+            self._done = {0}
+            self._finished = True
+            return self
+
+        self.size, self.ranged = remote_size(self.url, self.timeout)
+        if self.size is None or not self.ranged:
+            self.chunks = [(0, self.size)]
+        else:
+            self.chunks = [
+                (start, min(start + self.chunk_size, self.size))
+                for start in range(0, self.size, self.chunk_size)
+            ]
+        self._done = self._load_state()
+        self._written = [
+            (end - start) if i in self._done else 0
+            for i, (start, end) in enumerate(self.chunks)
+        ]
+        if not self.part.exists() or not self._done:
+            with open(self.part, "wb") as f:
+                if self.size is not None:
+                    f.truncate(self.size)
+
+        pending = [i for i in range(len(self.chunks)) if i not in self._done]
+        self._finished = not pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.connections, len(pending)))
+        )
+        self._futures = [self._executor.submit(self._fetch, i) for i in pending]
+        return self
+
+    def _load_state(self):
+        if not (self.state_file.exists() and self.part.exists()):
+            return set()
+        state = json.loads(self.state_file.read_text())
+        if (
+            state.get("url") != self.url
+            or state.get("size") != self.size
+            or state.get("chunk_size") != self.chunk_size
+        ):
+            return set()
+        return set(state["done"])
+
+    def _save_state(self):
+        state = {
+            "url": self.url,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "done": sorted(self._done),
+        }
+        tmp = self.state_file.with_name(self.state_file.name + ".tmp")
+        tmp.write_text(json.dumps(state))
+        tmp.replace(self.state_file)
+
+    def _fetch(self, i):
+        start, end = self.chunks[i]
+        error = None
+        for attempt in range(self.retries):
+            if self._cancelled:
+                return
+            try:
+                self._fetch_range(i, start, end)
+                with self._cond:
+                    self._done.add(i)
+                    self._save_state()
+                    self._finished = len(self._done) == len(self.chunks)
+                    self._cond.notify_all()
+                return
+            except (OSError, http.client.HTTPException, DownloadError) as e:
+                error = e
+                time.sleep(min(2**attempt, 30))
+        with self._cond:
+            self._error = DownloadError(
+                f"chunk {i} of {self.url} failed after {self.retries} attempts: {error}"
+            )
+            self._cond.notify_all()
+        raise self._error
+
+    def _fetch_range(self, i, start, end):
+        headers = {}
+        if self.ranged:
+            headers["Range"] = f"bytes={start + self._written[i]}-{end - 1}"
+        elif self._written[i]:
+            # without range support a retry starts over
+            with self._cond:
+                self._written[i] = 0
+        request = urllib.request.Request(self.url, headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if self.ranged and response.status != 206:
+                raise DownloadError(f"server ignored range request for chunk {i}")
+            with open(self.part, "r+b", buffering=0) as out:
+                out.seek(start + self._written[i])
+                while not self._cancelled:
+                    data = response.read(READ_SIZE)
+                    if not data:
+                        break
+                    out.write(data)
+                    with self._cond:
+                        self._written[i] += len(data)
+                        self._cond.notify_all()
+                    if self.progress and self.size:
+                        self.progress(sum(self._written), self.size)
+        if self._cancelled:
+            raise DownloadError("download cancelled")
+        if end is not None and start + self._written[i] != end:
+            raise DownloadError(
+                f"chunk {i} ended at byte {start + self._written[i]}, expected {end}"
+            )
+
+    def available(self, pos):
+        for i, (start, end) in enumerate(self.chunks):
+            if end is None or pos < end:
+                return start + self._written[i]
+        return self.size
+
+    def wait(self, pos):
+        with self._cond:
+            while True:
+                if self._error is not None:
+                    raise self._error
+                available = self.available(pos)
+                if available is not None and available > pos:
+                    return available
+                if self._finished:
+                    return pos
+                self._cond.wait(1)
+
+    def open(self):
+        return DownloadReader(self)
+
+    def cancel(self):
+        self._cancelled = True
+        for future in self._futures:
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def join(self):
+        for future in self._futures:
+            future.result()
+        if self._executor is not None:
+            self._executor.shutdown()
+        path = self.dest if self.dest.exists() and not self.part.exists() else self.part
+        size = path.stat().st_size
+        if self.size is not None and size != self.size:
+            raise DownloadError(f"{path} has {size} bytes, expected {self.size}")
+        if self.checksum is not None:
+            try:
+                self.verify(path)
+            except DownloadError as e:
+                # every chunk is recorded as done, so the next run would
+                # verify the same bytes again instead of downloading them
+                path.unlink(missing_ok=True)
+                self.state_file.unlink(missing_ok=True)
+                raise DownloadError(f"{e}, removed it to be downloaded again") from e
+        if path == self.part:
+            self.part.replace(self.dest)
+        self.state_file.unlink(missing_ok=True)
+        return self.dest
+
+    def verify(self, path):
+        algorithm, expected = self.checksum
+        digest = self._digest
+        if digest is None:
+            h = hashlib.new(algorithm)
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(READ_SIZE), b""):
+                    h.update(data)
+            digest = h.hexdigest()
+        if digest != expected:
+            raise DownloadError(f"{algorithm} of {path} is {digest}, expected {expected}")
+
+
+class DownloadReader(io.RawIOBase):
+    def __init__(self, download):
+        self.download = download
+        self.pos = 0
+        path = download.dest if download._finished and not download.part.exists() else download.part
+        # unbuffered, a read ahead would cache bytes that have not arrived yet
+        self._file = open(path, "rb", buffering=0)
+        self._hash = hashlib.new(download.checksum[0]) if download.checksum else None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        available = self.download.wait(self.pos)
+        n = min(len(buffer), available - self.pos)
+        if n <= 0:
+            if self._hash is not None:
+                self.download._digest = self._hash.hexdigest()
+            return 0
+        self._file.seek(self.pos)
+        view = memoryview(buffer)[:n]
+        n = self._file.readinto(view)
+        self.pos += n
+        if self._hash is not None:
+            self._hash.update(view[:n])
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def extract_stream(fileobj, outdir, on_member=None):
+    outdir = Path(outdir)
+    root = outdir.resolve()
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            target = (outdir / member.name).resolve()
+            if root != target and root not in target.parents:
+                raise DownloadError(f"refusing to extract {member.name} outside {outdir}")
+            tar.extract(member, outdir)
+            if member.isfile() and on_member is not None:
+                on_member(outdir / member.name)
+    # consume the end of archive padding so the whole file is hashed
+    while fileobj.read(READ_SIZE):
+        pass
+
+
+def download_and_extract(url, datadir, on_member=None, **kwargs):
+    dest = Path(datadir) / url.split("/")[-1]
+    download = RangedDownload(url, dest, **kwargs).start()
+    try:
+        with io.BufferedReader(download.open(), READ_SIZE) as stream:
+            extract_stream(stream, datadir, on_member)
+    except BaseException:
+        download.cancel()
+        raise
+    return download.join()
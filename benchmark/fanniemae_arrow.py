@@ -0,0 +1,213 @@
+import functools
+import glob
+
+import numpy as np
+import pyarrow
+import pyarrow.compute as pac
+import pyarrow.dataset as ds
+
+CHARGEOFF_CODES = ["02", "03", "09", "15"]
+PERF_COLUMNS = [
+    "loan_id",
+    "loan_age",
+    "current_actual_upb",
+    "zero_balance_code",
+    "disposition_date",
+]
+BATCH_ROWS = 1 << 20
+# partial aggregates are merged once this many have piled up
+MERGE_EVERY = 64
+
+# partial aggregates per (year, loan_age), the average is finished after merging
+PARTIALS = ["co_count_sum", "dollar_co_sum", "score_sum", "score_count", "upb_sum"]
+
+
+class ArrowQuery:
+    def __init__(self, perf, acq, threads=None, batch_rows=BATCH_ROWS):
+        self.perf = perf
+        self.acq = acq
+        self.threads = threads
+        self.batch_rows = batch_rows
+
+    def summary(self):
+        return summary(self.perf, self.acq, self.batch_rows)
+
+    def execute(self):
+        if self.threads is not None:
+            pyarrow.set_cpu_count(self.threads)
+        result = self.summary()
+        # ibis hands out dates as datetime64 columns
+        return result.to_pandas(date_as_object=False)
+
+
+class Backend:
+    """The part of the ibis backend API run.py needs, over pyarrow datasets."""
+
+    def __init__(self, threads=None):
+        self.threads = threads
+        self.tables = {}
+
+    def register(self, source, table_name, hive_partitioning=False):
+        files = sorted(glob.glob(source))
+        if not files:
+            # an empty dataset has no columns, the query would fail obscurely
+            raise FileNotFoundError(source)
+        # the partition columns are not used by the summary, only the files
+        self.tables[table_name] = ds.dataset(files)
+        return self.tables[table_name]
+
+    def table(self, name):
+        return self.tables[name]
+
+    def materialize(self, name):
+        self.tables[name] = ds.dataset(self.tables[name].to_table())
+
+
+def loans(acq):
+    return acq.to_table(
+        columns={
+            "loan_id": pac.field("loan_id"),
+            "year": pac.field("orig_date"),
+            "score": pac.field("borrower_credit_score"),
+        }
+    )
+
+
+def chargeoffs(batch):
+    zero_balance_code = batch["zero_balance_code"]
+    if pyarrow.types.is_dictionary(zero_balance_code.type):
+        zero_balance_code = zero_balance_code.dictionary_decode()
+    # null codes or dates are not charge offs, like the CASE in summary_query
+    chargeoff = pac.and_(
+        pac.is_in(zero_balance_code, value_set=pyarrow.array(CHARGEOFF_CODES)),
+        pac.is_valid(batch["disposition_date"]),
+    )
+    upb = batch["current_actual_upb"]
+    return {
+        "loan_age": batch["loan_age"],
+        "upb": upb,
+        "co_count": pac.cast(chargeoff, pyarrow.int64()),
+        "dollar_co": pac.if_else(chargeoff, upb, pyarrow.scalar(0, upb.type)),
+    }
+
+
+def aggregate(table):
+    return table.group_by(["year", "loan_age"]).aggregate(
+        [
+            ("co_count", "sum"),
+            ("dollar_co", "sum"),
+            ("score", "sum"),
+            ("score", "count"),
+            ("upb", "sum"),
+        ]
+    )
+
+
+class LoanIndex:
+    """The loans sorted by loan_id, built once per query. Joining a perf batch
+    is a binary search over the sorted ids instead of a hash table built over
+    every loan for every batch."""
+
+    def __init__(self, loans_table):
+        # null ids match nothing in an inner join
+        self.loans = loans_table.filter(pac.is_valid(loans_table["loan_id"]))
+        self.loans = self.loans.sort_by("loan_id")
+        self.loan_ids = self.loans["loan_id"].to_numpy()
+        self.unique = bool((np.diff(self.loan_ids) != 0).all())
+
+    def find(self, loan_id):
+        """Rows of ``loan_id`` and of the loans they match, one pair per match
+        like an inner join."""
+        ids = loan_id.to_numpy(zero_copy_only=False)
+        start = np.searchsorted(self.loan_ids, ids, "left")
+        if not len(self.loan_ids):
+            return np.array([], np.int64), start[:0]
+        if self.unique:
+            end = start.clip(max=len(self.loan_ids) - 1)
+            rows = np.flatnonzero(
+                (start < len(self.loan_ids)) & (self.loan_ids[end] == ids)
+            )
+            return rows, start[rows]
+        counts = np.searchsorted(self.loan_ids, ids, "right") - start
+        rows = np.repeat(np.arange(len(ids)), counts)
+        # the n-th match of a row is the n-th loan from its first one
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, np.repeat(start, counts) + offsets
+
+
+def partial_summary(batch, index):
+    if batch["loan_id"].null_count:
+        batch = batch.filter(pac.is_valid(batch["loan_id"]))
+    rows, positions = index.find(batch["loan_id"])
+    batch = batch.take(pyarrow.array(rows))
+    positions = pyarrow.array(positions)
+    perf = pyarrow.table(
+        {
+            "year": index.loans["year"].take(positions),
+            "score": index.loans["score"].take(positions),
+            **chargeoffs(batch),
+        }
+    )
+    return aggregate(perf)
+
+
+def merge(partials):
+    merged = pyarrow.concat_tables(partials).group_by(["year", "loan_age"])
+    merged = merged.aggregate([(c, "sum") for c in PARTIALS])
+    names = {f"{c}_sum": c for c in PARTIALS}
+    return merged.rename_columns([names.get(c, c) for c in merged.column_names])
+
+
+def scan(perf, partial, batch_rows=BATCH_ROWS):
+    """Merged ``partial`` aggregates of the perf batches with a positive
+    loan_age, memory is bounded by the batch size."""
+    columns = pyarrow.schema([perf.schema.field(c) for c in PERF_COLUMNS])
+    # an empty batch keeps the result typed when no perf rows match
+    partials = [partial(pyarrow.RecordBatch.from_pylist([], columns))]
+    batches = perf.to_batches(
+        columns=PERF_COLUMNS,
+        filter=pac.field("loan_age") > 0,
+        batch_size=batch_rows,
+    )
+    for batch in batches:
+        if batch.num_rows:
+            partials.append(partial(batch))
+        if len(partials) >= MERGE_EVERY:
+            partials = [merge(partials)]
+    return merge(partials)
+
+
+def loan_counts(loans_table):
+    return loans_table.group_by("year").aggregate([("loan_id", "count")])
+
+
+def summary(perf, acq, batch_rows=BATCH_ROWS):
+    """``summary_query`` from fanniemae_summary. perf is scanned batch by batch,
+    joined to the loans indexed once, and the per batch aggregates are merged,
+    so memory is bounded by the batch size and the three acquisition
+    columns."""
+    loans_table = loans(acq)
+    index = LoanIndex(loans_table)
+    totals = scan(perf, functools.partial(partial_summary, index=index), batch_rows)
+    return finish(totals, loan_counts(loans_table))
+
+
+def finish(totals, loan_counts):
+    result = totals.join(loan_counts, "year", join_type="inner")
+    return pyarrow.table(
+        {
+            "year": result["year"],
+            "loan_age": result["loan_age"],
+            "count(loan_id)": result["loan_id_count"],
+            "avg_credit_score": pac.divide(
+                pac.cast(result["score_sum"], pyarrow.float64()),
+                result["score_count"],
+            ),
+            "upb_sum": result["upb_sum"],
+            "dollar_co": result["dollar_co_sum"],
+        }
+    )
+
+
+def summary_query(db):
+    return ArrowQuery(db.table("perf"), db.table("acq"), db.threads)
@@ -0,0 +1,147 @@
+import functools
+import json
+import os
+import time
+
+import dask
+import psutil
+import pyarrow
+import pyarrow.dataset as ds
+
+from benchmark import fanniemae_arrow
+from benchmark.memory import MIB, peak_rss
+
+
+def split_files(files, shards):
+    """Perf files of every shard, the largest files go first to the shard with
+    the fewest bytes so far."""
+    loads = [[0, []] for _ in range(max(min(shards, len(files)), 1))]
+    for f in sorted(files, key=os.path.getsize, reverse=True):
+        load = min(loads, key=lambda load: load[0])
+        load[0] += os.path.getsize(f)
+        load[1].append(f)
+    return [sorted(files) for _, files in loads]
+
+
+def shard_summary(
+    files, schema, index, threads=None, batch_rows=fanniemae_arrow.BATCH_ROWS
+):
+    """Partial aggregates of the perf ``files`` with the wall time, the cpu
+    time of the worker process and its peak RSS, which the query process
+    cannot measure itself."""
+    process = psutil.Process()
+    start_cpu = process.cpu_times()
+    start_time = time.perf_counter()
+    if threads is not None:
+        pyarrow.set_cpu_count(threads)
+    totals = fanniemae_arrow.scan(
+        ds.dataset(files, schema=schema),
+        functools.partial(fanniemae_arrow.partial_summary, index=index),
+        batch_rows,
+    )
+    end_cpu = process.cpu_times()
+    cpu = end_cpu.user + end_cpu.system - start_cpu.user - start_cpu.system
+    return totals, time.perf_counter() - start_time, cpu, peak_rss()
+
+
+def compute_shards(shards, schema, index, threads=None, scheduler=None, **kwargs):
+    if scheduler is None:
+        tasks = [
+            dask.delayed(shard_summary)(files, schema, index, threads, **kwargs)
+            for files in shards
+        ]
+        # spawned workers would import run.py again before every query
+        with dask.config.set({"multiprocessing.context": "fork"}):
+            return dask.compute(
+                *tasks, scheduler="processes", num_workers=len(shards)
+            )
+
+    from distributed import Client
+
+    with Client(scheduler) as client:
+        # every worker receives the indexed acquisition columns once
+        index = client.scatter(index, broadcast=True)
+        futures = [
+            client.submit(
+                shard_summary, files, schema, index, threads, pure=False, **kwargs
+            )
+            for files in shards
+        ]
+        return client.gather(futures)
+
+
+def shard_stats(times, cpu_times, peaks, shards):
+    mean = sum(times) / len(times)
+    return {
+        "shards": len(shards),
+        "shard_files": json.dumps([len(files) for files in shards]),
+        "shard_times": json.dumps(times),
+        "shard_time_max": max(times),
+        "shard_time_mean": mean,
+        # the slowest shard relative to the average one, 1 is no skew
+        "shard_skew": max(times) / mean if mean else 1.0,
+        "shard_cpu_times": json.dumps(cpu_times),
+        # the workers' cpu time, part of total_time_cpu unless they are remote
+        "shard_cpu_time": sum(cpu_times),
+        "shard_peak_rss": json.dumps([peak / MIB for peak in peaks]),
+        "shard_peak_rss_max": max(peaks) / MIB,
+    }
+
+
+class ShardedQuery(fanniemae_arrow.ArrowQuery):
+    def __init__(
+        self,
+        perf,
+        acq,
+        shards,
+        scheduler=None,
+        threads=None,
+        batch_rows=fanniemae_arrow.BATCH_ROWS,
+    ):
+        super().__init__(perf, acq, threads, batch_rows)
+        self.shards = shards
+        self.scheduler = scheduler
+        self.stats = {}
+
+    def summary(self):
+        loans = fanniemae_arrow.loans(self.acq)
+        shards = split_files(self.perf.files, self.shards)
+        results = compute_shards(
+            shards,
+            self.perf.schema,
+            fanniemae_arrow.LoanIndex(loans),
+            self.threads,
+            self.scheduler,
+            batch_rows=self.batch_rows,
+        )
+        partials, times, cpu_times, peaks = zip(*results)
+        self.stats = shard_stats(list(times), list(cpu_times), list(peaks), shards)
+        totals = fanniemae_arrow.merge(list(partials))
+        return fanniemae_arrow.finish(totals, fanniemae_arrow.loan_counts(loans))
+
+
+class Backend(fanniemae_arrow.Backend):
+    """pyarrow backend that splits the perf files into shards and computes
+    their partial aggregates on dask workers, local processes unless a
+    distributed scheduler is given. Workers on other hosts need the data
+    directory at the same path."""
+
+    def __init__(self, threads=None):
+        super().__init__(threads)
+        self.shards = os.cpu_count()
+        self.scheduler = None
+
+    def use_cluster(self, shards=None, scheduler=None):
+        self.shards = shards or os.cpu_count()
+        self.scheduler = scheduler
+
+    def materialize(self, name):
+        # perf stays a list of files to be split into shards
+        if name != "perf":
+            super().materialize(name)
+
+
+def summary_query(db):
+    return ShardedQuery(
+        db.table("perf"), db.table("acq"), db.shards, db.scheduler, db.threads
+    )
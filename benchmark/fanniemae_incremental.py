@@ -0,0 +1,111 @@
+import functools
+import json
+import os
+from pathlib import Path
+
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from benchmark import fanniemae_arrow
+
+STATE_DIR = "incremental"
+STATE_FILE = "state.parquet"
+MANIFEST_FILE = "manifest.json"
+
+
+def state_dir(datadir):
+    return Path(datadir) / STATE_DIR
+
+
+def fingerprint(files):
+    fingerprints = {}
+    for f in files:
+        stat = os.stat(f)
+        fingerprints[str(Path(f).resolve())] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def load_state(path):
+    path = Path(path)
+    if not (path / MANIFEST_FILE).exists():
+        return None, {"perf": {}, "acq": {}}
+    manifest = json.loads((path / MANIFEST_FILE).read_text())
+    return pq.read_table(path / STATE_FILE), manifest
+
+
+def save_state(path, state, manifest):
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    # written aside and renamed, an interrupted refresh leaves the old state
+    pq.write_table(state, path / f"{STATE_FILE}.tmp")
+    (path / f"{MANIFEST_FILE}.tmp").write_text(json.dumps(manifest, indent=1))
+    os.replace(path / f"{STATE_FILE}.tmp", path / STATE_FILE)
+    os.replace(path / f"{MANIFEST_FILE}.tmp", path / MANIFEST_FILE)
+
+
+def refresh(perf, acq, path, batch_rows=fanniemae_arrow.BATCH_ROWS):
+    """Merge the aggregates of the perf files not seen before into the state
+    stored in ``path`` and return the updated state with the number of files
+    scanned. Changed or removed perf files and any change to acq invalidate
+    the state, which is then rebuilt from every perf file."""
+    state, manifest = load_state(path)
+    perf_files = fingerprint(perf.files)
+    acq_files = fingerprint(acq.files)
+    stale = manifest["acq"] != acq_files or any(
+        perf_files.get(f) != seen for f, seen in manifest["perf"].items()
+    )
+    if stale:
+        state, manifest = None, {"perf": {}, "acq": acq_files}
+    new_files = [f for f in perf_files if f not in manifest["perf"]]
+    if state is None or new_files:
+        index = fanniemae_arrow.LoanIndex(fanniemae_arrow.loans(acq))
+        delta = fanniemae_arrow.scan(
+            ds.dataset(new_files, schema=perf.schema),
+            functools.partial(fanniemae_arrow.partial_summary, index=index),
+            batch_rows,
+        )
+        state = delta if state is None else fanniemae_arrow.merge([state, delta])
+        manifest["perf"].update({f: perf_files[f] for f in new_files})
+        save_state(path, state, manifest)
+    return state, len(new_files)
+
+
+class IncrementalQuery(fanniemae_arrow.ArrowQuery):
+    def __init__(
+        self,
+        perf,
+        acq,
+        state_path,
+        threads=None,
+        batch_rows=fanniemae_arrow.BATCH_ROWS,
+    ):
+        super().__init__(perf, acq, threads, batch_rows)
+        self.state_path = state_path
+
+    def summary(self):
+        state, _ = refresh(self.perf, self.acq, self.state_path, self.batch_rows)
+        counts = fanniemae_arrow.loan_counts(fanniemae_arrow.loans(self.acq))
+        return fanniemae_arrow.finish(state, counts)
+
+
+class Backend(fanniemae_arrow.Backend):
+    """pyarrow backend whose summary only scans the perf files that arrived
+    since the state in ``state_path`` was saved."""
+
+    def __init__(self, threads=None):
+        super().__init__(threads)
+        self.state_path = None
+
+    def register_state(self, path):
+        self.state_path = Path(path)
+
+    def materialize(self, name):
+        # the tables stay lists of files to find what changed since the state
+        # was saved
+        pass
+
+
+def summary_query(db):
+    return IncrementalQuery(
+        db.table("perf"), db.table("acq"), db.state_path, db.threads
+    )
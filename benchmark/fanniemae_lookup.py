@@ -0,0 +1,128 @@
+import functools
+from pathlib import Path
+
+import numpy as np
+import pyarrow
+import pyarrow.compute as pac
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from benchmark import fanniemae_arrow
+from benchmark.layout import table_dir
+
+LOOKUP_DIR = "lookup"
+
+
+def lookup_dir(datadir):
+    return Path(datadir) / LOOKUP_DIR
+
+
+def build_lookup(datadir, layout="flat"):
+    """Write the acquisition dimension the lookup engine reads instead of
+    joining acq: loans.parquet holds loan_id in sorted order with a year code
+    and the credit score, years.parquet the year of each code and its loan
+    count. Returns the number of loans."""
+    files = sorted(table_dir(datadir, "acq", layout).rglob("*.parquet"))
+    acq = ds.dataset(files).to_table(
+        columns=["loan_id", "orig_date", "borrower_credit_score"]
+    )
+    # loan counts per year count every acquisition row like the join plan
+    years = acq.group_by("orig_date").aggregate([("loan_id", "count")])
+    years = years.filter(pac.is_valid(years["orig_date"]))
+    years = years.sort_by("orig_date")
+
+    acq = acq.filter(pac.is_valid(acq["loan_id"])).sort_by("loan_id")
+    loans = pyarrow.table(
+        {
+            "loan_id": acq["loan_id"],
+            "year_code": pac.index_in(acq["orig_date"], value_set=years["orig_date"]),
+            "borrower_credit_score": acq["borrower_credit_score"],
+        }
+    )
+    outdir = lookup_dir(datadir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    pq.write_table(loans, outdir / "loans.parquet")
+    pq.write_table(
+        pyarrow.table(
+            {
+                "year_code": pyarrow.array(range(len(years)), pyarrow.int32()),
+                "year": years["orig_date"],
+                "loan_id_count": years["loan_id_count"],
+            }
+        ),
+        outdir / "years.parquet",
+    )
+    return len(loans)
+
+
+class Lookup:
+    def __init__(self, path):
+        self.loans = pq.read_table(Path(path) / "loans.parquet")
+        self.years = pq.read_table(Path(path) / "years.parquet")
+        self.loan_ids = self.loans["loan_id"].to_numpy()
+
+    def find(self, loan_id):
+        """Positions of ``loan_id`` in the lookup and a mask of the ones found,
+        a binary search over the sorted ids instead of building a hash table."""
+        ids = loan_id.to_numpy(zero_copy_only=False)
+        positions = np.searchsorted(self.loan_ids, ids)
+        positions[positions == len(self.loan_ids)] = 0
+        return positions, self.loan_ids[positions] == ids
+
+
+class LookupQuery(fanniemae_arrow.ArrowQuery):
+    def summary(self):
+        return summary(self.perf, self.acq, self.batch_rows)
+
+
+class Backend(fanniemae_arrow.Backend):
+    def register(self, source, table_name, hive_partitioning=False):
+        if table_name == "acq":
+            # acq is replaced by the lookup built by prepare.py --lookup
+            return None
+        return super().register(source, table_name, hive_partitioning)
+
+    def register_lookup(self, path):
+        if not (Path(path) / "loans.parquet").exists():
+            raise FileNotFoundError(f"no lookup in {path}, run prepare.py --lookup")
+        self.tables["acq"] = Lookup(path)
+
+    def materialize(self, name):
+        if name != "acq":
+            super().materialize(name)
+
+
+def partial_summary(batch, lookup):
+    positions, found = lookup.find(batch["loan_id"])
+    rows = pyarrow.array(np.flatnonzero(found))
+    positions = pyarrow.array(positions[found])
+    batch = batch.take(rows)
+    perf = pyarrow.table(
+        {
+            # year codes stand in for the year until the partials are merged
+            "year": lookup.loans["year_code"].take(positions),
+            "score": lookup.loans["borrower_credit_score"].take(positions),
+            **fanniemae_arrow.chargeoffs(batch),
+        }
+    )
+    return fanniemae_arrow.aggregate(perf)
+
+
+def summary(perf, lookup, batch_rows=fanniemae_arrow.BATCH_ROWS):
+    """``summary_query`` in a single pass over perf, finding year and credit
+    score of every row in the acquisition lookup."""
+    totals = fanniemae_arrow.scan(
+        perf, functools.partial(partial_summary, lookup=lookup), batch_rows
+    )
+    totals = totals.filter(pac.is_valid(totals["year"]))
+    totals = totals.set_column(
+        totals.column_names.index("year"),
+        "year",
+        lookup.years["year"].take(totals["year"]),
+    )
+    loan_counts = lookup.years.select(["year", "loan_id_count"])
+    return fanniemae_arrow.finish(totals, loan_counts)
+
+
+def summary_query(db):
+    return LookupQuery(db.table("perf"), db.table("acq"), db.threads)
@@ -0,0 +1,97 @@
+import polars as pl
+
+CHARGEOFF_CODES = ["02", "03", "09", "15"]
+
+
+def collect(frame):
+    try:
+        return frame.collect(engine="streaming")
+    except TypeError:
+        # polars releases before the streaming engine rewrite
+        return frame.collect(streaming=True)
+
+
+class PolarsQuery:
+    # the polars thread pool is gone in a forked child and queries hang
+    spawn = True
+
+    def __init__(self, frame, threads=None):
+        self.frame = frame
+        self.threads = threads
+
+    @property
+    def environment(self):
+        # read once by the spawned child when it imports polars
+        if self.threads is None:
+            return {}
+        return {"POLARS_MAX_THREADS": str(self.threads)}
+
+    def execute(self):
+        return collect(self.frame).to_pandas()
+
+
+class Backend:
+    """The part of the ibis backend API run.py needs, over polars lazy frames.
+    polars sizes its thread pool once per process from POLARS_MAX_THREADS."""
+
+    def __init__(self, threads=None):
+        self.threads = threads
+        self.tables = {}
+
+    def register(self, source, table_name, hive_partitioning=False):
+        self.tables[table_name] = pl.scan_parquet(
+            source, hive_partitioning=hive_partitioning
+        )
+        return self.tables[table_name]
+
+    def table(self, name):
+        return self.tables[name]
+
+    def materialize(self, name):
+        self.tables[name] = collect(self.tables[name]).lazy()
+
+
+def summary_query(db):
+    perf = db.table("perf")
+    acq = db.table("acq").select(
+        "loan_id", pl.col("orig_date").alias("year"), "borrower_credit_score"
+    )
+
+    chargeoff = pl.col("zero_balance_code").cast(pl.Utf8).is_in(
+        CHARGEOFF_CODES
+    ) & pl.col("disposition_date").is_not_null()
+
+    loans = acq.join(perf, on="loan_id").select(
+        "loan_id",
+        pl.when(chargeoff).then(1).otherwise(0).alias("chargeoffs"),
+        pl.when(chargeoff)
+        .then(pl.col("current_actual_upb"))
+        .otherwise(0)
+        .alias("dollar_co"),
+        "loan_age",
+        "current_actual_upb",
+        "year",
+        "borrower_credit_score",
+    )
+
+    summary = (
+        loans.filter(pl.col("loan_age") > 0)
+        .group_by("year", "loan_age")
+        .agg(
+            pl.col("chargeoffs").cast(pl.Int64).sum().alias("co_count"),
+            pl.col("dollar_co").sum(),
+            pl.col("borrower_credit_score").mean().alias("avg_credit_score"),
+            pl.col("current_actual_upb").sum().alias("upb_sum"),
+        )
+    )
+    acq_agg = acq.group_by("year").agg(pl.col("loan_id").count().alias("count(loan_id)"))
+
+    summary = summary.join(acq_agg, on="year").select(
+        "year",
+        "loan_age",
+        "count(loan_id)",
+        "avg_credit_score",
+        "upb_sum",
+        "dollar_co",
+    )
+    return PolarsQuery(summary, db.threads)
@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import pyarrow
+
+LAYOUTS = ["flat", "hive"]
+HIVE_DIR = "hive"
+
+PARTITIONS = {
+    "perf": {
+        "reporting_year": pyarrow.int16(),
+        "reporting_quarter": pyarrow.int8(),
+    },
+    "acq": {
+        "orig_year": pyarrow.int16(),
+    },
+}
+
+
+def table_dir(datadir, table, layout="flat"):
+    if layout == "hive":
+        return Path(datadir) / HIVE_DIR / table
+    return Path(datadir) / table
+
+
+def table_glob(datadir, table, layout="flat"):
+    if layout == "hive":
+        partition_dirs = ["*"] * len(PARTITIONS[table])
+        return table_dir(datadir, table, layout).joinpath(*partition_dirs, "*.parquet")
+    return table_dir(datadir, table, layout) / "*.parquet"
+
+
+def partitioning(table):
+    return pyarrow.schema(list(PARTITIONS[table].items()))
@@ -0,0 +1,120 @@
+import os
+import resource
+import sys
+import threading
+import time
+
+import psutil
+
+MIB = 1 << 20
+
+
+def peak_rss():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on OSX
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Sampler:
+    """Call ``read`` every ``interval`` seconds on a background thread while
+    the context is active and keep the timestamped results in ``samples``."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def read(self):
+        raise NotImplementedError
+
+    def _sample(self):
+        while not self._stop.is_set():
+            try:
+                value = self.read()
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                return
+            self.samples.append((time.monotonic() - self._start, *value))
+            self._stop.wait(self.interval)
+
+
+def process_memory(process):
+    try:
+        info = process.memory_full_info()
+        return info.rss, info.uss
+    except psutil.AccessDenied:
+        return process.memory_info().rss, None
+
+
+class MemorySampler(Sampler):
+    """Sample RSS and USS of process ``pid`` together with the worker processes
+    it started, e.g. dask's local workers. RSS includes memory the engines
+    allocate natively, outside of the python allocator. Pages a worker shares
+    with its parent after a fork count towards both RSS but only once towards
+    USS."""
+
+    def __init__(self, pid, interval=0.05):
+        super().__init__(interval)
+        self.process = psutil.Process(pid)
+
+    def read(self):
+        rss, uss = process_memory(self.process)
+        for child in self.process.children(recursive=True):
+            try:
+                child_rss, child_uss = process_memory(child)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                # workers exit while the query runs
+                continue
+            rss += child_rss
+            uss = uss + child_uss if None not in (uss, child_uss) else None
+        return rss, uss
+
+    @property
+    def max_rss(self):
+        return max((rss for _, rss, _ in self.samples), default=0)
+
+    @property
+    def max_uss(self):
+        return max((uss or 0 for _, _, uss in self.samples), default=0)
+
+    def series(self):
+        return [
+            [round(t, 4), rss / MIB, uss / MIB if uss is not None else None]
+            for t, rss, uss in self.samples
+        ]
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                # spill files come and go while the query runs
+                pass
+    return size
+
+
+class SpillSampler(Sampler):
+    """Sample the size of the spill directory ``path``."""
+
+    def __init__(self, path, interval=0.05):
+        super().__init__(interval)
+        self.path = path
+
+    def read(self):
+        return (directory_size(self.path),)
+
+    @property
+    def max_size(self):
+        return max((size for _, size in self.samples), default=0)
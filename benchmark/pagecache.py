@@ -0,0 +1,25 @@
+import os
+import subprocess
+from pathlib import Path
+from shutil import which
+
+
+def dataset_files(datadir):
+    return sorted(Path(datadir).rglob("*.parquet"))
+
+
+def evict(paths):
+    if hasattr(os, "posix_fadvise"):
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                # dirty pages are not dropped, flush them first
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    elif which("purge") is not None:
+        # OSX has no per file eviction, purge drops the whole cache as root
+        subprocess.run(["purge"], check=True)
+    else:
+        raise RuntimeError("evicting the page cache needs posix_fadvise or purge")
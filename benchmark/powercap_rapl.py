@@ -1,52 +1,138 @@
 import time
-import timeit
-from multiprocessing import Pipe, Process
-
-
-class PowercapRapl(Process):
-    def __init__(self, pipe, *args, **kw):
-        self.pipe = pipe
-        super(PowercapRapl, self).__init__(*args, **kw)
-
-    def run(self):
-        self.pipe.send(0)
-        stop = False
-        energy_uj = []
-        start_time = timeit.default_timer()
-        while True:
-            with open(
-                "/sys/devices/virtual/powercap/intel-rapl/intel-rapl:0/energy_uj"
-            ) as rapl:
-                energy_uj.append(int(rapl.read()))
-            if stop:
-                if energy_uj[0] > energy_uj[-1]:
-                    energy_uj[-1] = energy_uj[-1] + 65532610987
-                stop_time = timeit.default_timer()
-                self.pipe.send((energy_uj[-1] - energy_uj[0], stop_time - start_time))
-                break
-            stop = self.pipe.poll(0.1)
+from pathlib import Path
+
+from benchmark.memory import Sampler
+
+POWERCAP_ROOT = "/sys/devices/virtual/powercap"
+
+
+class Domain:
+    """A RAPL energy counter, a package or one of its core, uncore and dram
+    sub-domains."""
+
+    def __init__(self, path, name):
+        self.path = Path(path)
+        self.name = name
+        self.max_energy_range_uj = int((self.path / "max_energy_range_uj").read_text())
+
+    def read(self):
+        return int((self.path / "energy_uj").read_text())
+
+    def __repr__(self):
+        return f"Domain({self.name!r}, {str(self.path)!r})"
+
+
+def discover_domains(root=POWERCAP_ROOT):
+    """Every package below ``root`` named like package-0, and its sub-domains
+    as e.g. package-0/dram."""
+    domains = []
+    for package in sorted(Path(root).glob("intel-rapl/intel-rapl:*")):
+        name = (package / "name").read_text().strip()
+        domains.append(Domain(package, name))
+        for sub in sorted(package.glob(f"{package.name}:*")):
+            sub_name = (sub / "name").read_text().strip()
+            domains.append(Domain(sub, f"{name}/{sub_name}"))
+    return domains
+
+
+def energy_delta(start, end, max_energy_range_uj):
+    # the counter wraps around to 0 after max_energy_range_uj
+    if end < start:
+        end += max_energy_range_uj
+    return end - start
+
+
+class RaplSampler(Sampler):
+    """Read the energy counters of ``domains`` every ``interval`` seconds on a
+    background thread, a reading is only a few small file reads."""
+
+    def __init__(self, domains=None, interval=0.1, root=POWERCAP_ROOT):
+        super().__init__(interval)
+        self.domains = discover_domains(root) if domains is None else domains
+
+    def read(self):
+        return tuple(d.read() for d in self.domains)
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        # the last reading is taken on exit, not up to an interval before
+        self.samples.append((time.monotonic() - self._start, *self.read()))
+
+    def series(self):
+        """Energy in uJ used by every domain since the first reading, per
+        reading at its time after the first one, with wraparounds corrected."""
+        series = []
+        totals = [0] * len(self.domains)
+        first, *previous = self.samples[0] if self.samples else (0.0,)
+        for t, *counters in self.samples:
+            for i, (domain, start, end) in enumerate(
+                zip(self.domains, previous, counters)
+            ):
+                totals[i] += energy_delta(start, end, domain.max_energy_range_uj)
+            previous = counters
+            series.append([round(t - first, 4), *totals])
+        return series
+
+    @property
+    def total_time(self):
+        # on the time base of series
+        if not self.samples:
+            return 0.0
+        return round(self.samples[-1][0] - self.samples[0][0], 4)
+
+    @property
+    def energy_uj(self):
+        last = self.series()[-1][1:] if self.samples else [0] * len(self.domains)
+        return {d.name: energy for d, energy in zip(self.domains, last)}
+
+    def energy_between(self, start, end):
+        """Energy in uJ per domain between two times relative to the first
+        reading, interpolated between the readings around them."""
+        series = self.series()
+
+        def at(t):
+            for (t0, *e0), (t1, *e1) in zip(series, series[1:]):
+                if t0 <= t <= t1:
+                    w = (t - t0) / (t1 - t0) if t1 > t0 else 0.0
+                    return [a + (b - a) * w for a, b in zip(e0, e1)]
+            return series[0][1:] if t < series[0][0] else series[-1][1:]
+
+        return {
+            d.name: e1 - e0 for d, e0, e1 in zip(self.domains, at(start), at(end))
+        }
 
 
 class PowercapRaplProfiler:
-    def __init__(self):
+    """Package energy in uJ summed over all sockets as ``results`` and the
+    sampled time as ``total_time``, every domain in ``domains``."""
+
+    def __init__(self, interval=0.1, root=POWERCAP_ROOT):
+        self.sampler = RaplSampler(interval=interval, root=root)
         self.results = []
         self.total_time = None
+        self.domains = {}
 
     def __enter__(self):
-        self.child_conn, self.parent_conn = Pipe()
-        p = PowercapRapl(self.child_conn)
-        p.start()
-        self.parent_conn.recv()
+        self.sampler.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.parent_conn.send(0)
-        self.results, self.total_time = self.parent_conn.recv()
+        self.sampler.__exit__(exc_type, exc_value, exc_traceback)
+        self.domains = self.sampler.energy_uj
+        self.results = sum(
+            energy for name, energy in self.domains.items() if "/" not in name
+        )
+        self.total_time = self.sampler.total_time
         return False
 
+    def series(self):
+        return self.sampler.series()
+
 
 if __name__ == "__main__":
     with PowercapRaplProfiler() as p:
         time.sleep(5)
     print(p.results, p.total_time)
     print("mW: {}".format(p.results / p.total_time / 10 ** 3))
+    for name, energy in p.domains.items():
+        print(f"{name} mW: {energy / p.total_time / 10 ** 3}")
@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+TOP_OPERATORS = 5
+
+UNITS = {"ns": 1e-9, "µs": 1e-6, "us": 1e-6, "ms": 1e-3, "s": 1.0}
+DURATION = re.compile(r"([\d.]+)(ns|µs|us|ms|s)$")
+
+
+@contextmanager
+def capture_stdout(path):
+    # datafusion prints from rust, so python level redirection misses it
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(path, "w") as f:
+        os.dup2(f.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def duckdb_operators(node):
+    operators = []
+    for child in node.get("children", []):
+        operators.append(
+            {
+                "operator": child["name"],
+                "time": child["timing"],
+                "rows": child["cardinality"],
+            }
+        )
+        operators.extend(duckdb_operators(child))
+    return operators
+
+
+def profile_duckdb(db, expression, path):
+    db.con.execute("PRAGMA enable_profiling='json'")
+    db.con.execute(f"PRAGMA profiling_output='{path}'")
+    try:
+        expression.execute()
+    finally:
+        db.con.execute("PRAGMA disable_profiling")
+    return duckdb_operators(json.loads(Path(path).read_text()))
+
+
+def parse_duration(value):
+    match = DURATION.match(value)
+    return float(match.group(1)) * UNITS[match.group(2)] if match else 0.0
+
+
+def datafusion_operators(text):
+    operators = []
+    for line in text.splitlines():
+        cells = line.split("|")
+        if len(cells) < 3 or "metrics=[" not in cells[2]:
+            continue
+        plan = cells[2].strip()
+        metrics = dict(
+            m.split("=", 1)
+            for m in plan[plan.index("metrics=[") + 9 : plan.rindex("]")].split(", ")
+            if "=" in m
+        )
+        # scans report their work as processing time rather than compute time
+        elapsed = max(
+            parse_duration(metrics.get("elapsed_compute", "")),
+            parse_duration(metrics.get("time_elapsed_processing", "")),
+        )
+        operators.append(
+            {
+                "operator": re.match(r"\w+", plan).group(0),
+                "time": elapsed,
+                "rows": int(metrics.get("output_rows", 0)),
+            }
+        )
+    return operators
+
+
+def profile_datafusion(db, expression, path):
+    frame = db.compile(expression)
+    with capture_stdout(path):
+        frame.explain(False, True)
+    return datafusion_operators(Path(path).read_text())
+
+
+PROFILERS = {"duckdb": profile_duckdb, "datafusion": profile_datafusion}
+EXTENSIONS = {"duckdb": "json", "datafusion": "txt"}
+
+
+def profile_query(db, expression, engine, path, top=TOP_OPERATORS):
+    """Run ``expression`` once with the engine's operator profiling enabled,
+    keep the raw profile at ``path`` and return the ``top`` operators by time."""
+    operators = PROFILERS[engine](db, expression, path)
+    operators.sort(key=lambda o: o["time"], reverse=True)
+    return {
+        "profile": str(path),
+        "top_operators": json.dumps(operators[:top]),
+    }
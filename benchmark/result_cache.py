@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import ibis
+import pyarrow
+import pyarrow.ipc
+
+# bytes hashed at each end of a file, parquet keeps its metadata at the end
+HASH_BYTES = 1 << 20
+EXTENSION = "arrow"
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(HASH_BYTES))
+        if stat.st_size > 2 * HASH_BYTES:
+            f.seek(-HASH_BYTES, os.SEEK_END)
+        digest.update(f.read(HASH_BYTES))
+    return [str(path), stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+
+def query_text(expression):
+    """The SQL an ibis expression compiles to. ibis 5 compiles datafusion
+    expressions straight to a DataFrame, those are keyed by the expression
+    tree, and the engines outside of ibis by their query class."""
+    if not isinstance(expression, ibis.expr.types.Expr):
+        kind = type(expression)
+        return f"{kind.__module__}.{kind.__qualname__}"
+    try:
+        return str(ibis.to_sql(expression))
+    except NotImplementedError:
+        return repr(expression)
+
+
+def write_result(path, result):
+    table = pyarrow.Table.from_pandas(result, preserve_index=False)
+    tmp = Path(f"{path}.tmp{os.getpid()}")
+    with pyarrow.ipc.new_file(tmp, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def read_result(path):
+    with pyarrow.ipc.open_file(path) as reader:
+        return reader.read_all().to_pandas(date_as_object=False)
+
+
+class ResultCache:
+    """Query results as Arrow IPC files in ``path``, keyed by query, engine
+    and the input files. The least recently used results are evicted once
+    the cache is larger than ``max_bytes``."""
+
+    def __init__(self, path, max_bytes):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, query, engine, files):
+        fingerprint = {
+            "query": query,
+            "engine": engine,
+            "files": [file_fingerprint(f) for f in sorted(files)],
+        }
+        return hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()
+
+    def entry(self, key):
+        return self.path / f"{key}.{EXTENSION}"
+
+    def get(self, key):
+        entry = self.entry(key)
+        if not entry.exists():
+            self.misses += 1
+            return None
+        self.hits += 1
+        # the modification time orders the entries for eviction
+        os.utime(entry)
+        return read_result(entry)
+
+    def put(self, key, result):
+        write_result(self.entry(key), result)
+        self.evict()
+
+    def evict(self):
+        entries = sorted(
+            (e.stat().st_mtime_ns, e.stat().st_size, e)
+            for e in self.path.glob(f"*.{EXTENSION}")
+        )
+        size = sum(s for _, s, _ in entries)
+        for _, entry_size, entry in entries:
+            if size <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            size -= entry_size
+
+    def execute(self, expression, key):
+        result = self.get(key)
+        if result is None:
+            result = expression.execute()
+            self.put(key, result)
+        return result
+
+    @property
+    def stats(self):
+        return {"result_cache_hits": self.hits, "result_cache_misses": self.misses}
@@ -0,0 +1,183 @@
+import datetime
+import hashlib
+import json
+import math
+import platform
+import subprocess
+import uuid
+from importlib import metadata
+from pathlib import Path
+
+import pandas as pd
+
+from benchmark.result_cache import file_fingerprint
+from benchmark.stats import mann_whitney, relative_ci, summarize
+
+LIBRARIES = [
+    "duckdb",
+    "datafusion",
+    "ibis-framework",
+    "polars",
+    "pyarrow",
+    "pandas",
+    "dask",
+]
+# rows of two runs are compared when all of these match
+COMPARE_KEYS = ["benchmark", "datadir", "db", "name", "threads", "layout"]
+
+
+def library_versions():
+    versions = {"version_python": platform.python_version()}
+    for library in LIBRARIES:
+        try:
+            versions[f"version_{library}"] = metadata.version(library)
+        except metadata.PackageNotFoundError:
+            versions[f"version_{library}"] = None
+    return versions
+
+
+def git_revision(path="."):
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=path)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}-dirty" if dirty.returncode else revision
+
+
+def dataset_fingerprint(files):
+    fingerprints = [file_fingerprint(f)[1:] for f in sorted(files)]
+    return hashlib.sha256(json.dumps(fingerprints).encode()).hexdigest()[:16]
+
+
+def save_run(results_dir, df, benchmark, label=None, **run_info):
+    """Store the rows of one invocation in ``results_dir`` with what is needed
+    to tell runs apart later, and return its run id."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    run_id = f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    info = {
+        "run_id": run_id,
+        "recorded_at": now.isoformat(),
+        "label": label,
+        "benchmark": benchmark,
+        "git_revision": git_revision(Path(__file__).parent),
+        **library_versions(),
+        **run_info,
+    }
+    df = df.copy()
+    for column, value in reversed(list(info.items())):
+        df.insert(0, column, value)
+    results_dir = Path(results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    # every column as text keeps runs with differing columns readable together
+    df.astype(str).to_parquet(results_dir / f"{run_id}.parquet", index=False)
+    return run_id
+
+
+def load_runs(results_dir):
+    files = sorted(Path(results_dir).glob("*.parquet"))
+    if not files:
+        raise FileNotFoundError(f"no stored runs in {results_dir}")
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+
+
+def select_run(history, run):
+    """Rows of the run with id ``run``, or of the latest run labelled ``run``."""
+    rows = history[history.run_id == run]
+    if rows.empty:
+        labelled = history[history.label == run]
+        if labelled.empty:
+            raise KeyError(f"no run with id or label {run}")
+        latest = labelled.sort_values("recorded_at").run_id.iloc[-1]
+        rows = history[history.run_id == latest]
+    # columns only other runs have
+    return rows.dropna(axis=1, how="all")
+
+
+def time_samples(rows):
+    """Run times of all rows of a query, --repeat stores a row per repetition.
+    Cached results have none."""
+    samples = []
+    for _, row in rows.iterrows():
+        if row.get("time_samples") not in (None, "None", "nan"):
+            samples.extend(json.loads(row["time_samples"]))
+    return [t for t in samples if not math.isnan(t)]
+
+
+def peak_memory(rows):
+    return pd.to_numeric(rows.get("max_memory_usage"), errors="coerce").max()
+
+
+def interval(samples):
+    # a single run is taken as a point
+    return relative_ci(samples) if len(samples) > 1 else 0.0
+
+
+def compare_runs(
+    baseline, candidate, alpha=0.05, threshold=0.05, memory_threshold=0.10
+):
+    """A row per query of both runs with the relative change of the median
+    time and of peak memory. A slowdown is flagged when it is larger than
+    ``threshold`` and significant at ``alpha`` in a Mann-Whitney U test of the
+    run times, memory growth when it is larger than ``memory_threshold``."""
+    keys = [k for k in COMPARE_KEYS if k in baseline and k in candidate]
+    baseline = dict(list(baseline.groupby(keys)))
+    rows = []
+    for key, query_rows in candidate.groupby(keys):
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        row = dict(zip(keys, key))
+        base_samples, samples = time_samples(base), time_samples(query_rows)
+        failed = (base.get("failed") == "True").any() or (
+            query_rows.get("failed") == "True"
+        ).any()
+        if failed or not base_samples or not samples:
+            # nothing to compare, so nothing is flagged
+            rows.append(
+                {**row, "failed": bool(failed), "slowdown": False, "memory_growth": False}
+            )
+            continue
+        base_time = summarize(base_samples)["time_median"]
+        time = summarize(samples)["time_median"]
+        if len(base_samples) > 1 and len(samples) > 1:
+            p_value = mann_whitney(base_samples, samples)
+            significant = p_value < alpha
+        else:
+            # too few runs to rank, the confidence intervals have to separate
+            p_value = None
+            significant = time * (1 - interval(samples)) > base_time * (
+                1 + interval(base_samples)
+            )
+        time_change = time / base_time - 1
+        base_memory, memory = peak_memory(base), peak_memory(query_rows)
+        memory_change = memory / base_memory - 1
+        rows.append(
+            {
+                **row,
+                "failed": False,
+                "baseline_runs": len(base_samples),
+                "runs": len(samples),
+                "baseline_time": base_time,
+                "time": time,
+                "time_change": time_change,
+                "p_value": p_value,
+                "slowdown": bool(significant and time_change > threshold),
+                "baseline_memory": base_memory,
+                "memory": memory,
+                "memory_change": memory_change,
+                "memory_growth": bool(memory_change > memory_threshold),
+            }
+        )
+    df = pd.DataFrame(rows)
+    # runs without shared queries still have the flag columns
+    for flag in ("slowdown", "memory_growth"):
+        if flag not in df:
+            df[flag] = False
+    return df
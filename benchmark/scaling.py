@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from benchmark.layout import table_dir
+
+GIB = 1 << 30
+
+
+def thread_counts(max_threads):
+    counts = [1]
+    while counts[-1] * 2 < max_threads:
+        counts.append(counts[-1] * 2)
+    if max_threads > 1:
+        counts.append(max_threads)
+    return counts
+
+
+def thread_scaling(df, time="time_median", by=("datadir", "db", "name")):
+    """Add speedup, parallel efficiency and the Karp-Flatt serial fraction
+    relative to the single threaded run of each query."""
+    # failed runs have no times, there are no time columns when all failed
+    df = df.reindex(columns=df.columns.union([time], sort=False))
+    baseline = (
+        df[df.threads == 1].set_index(list(by))[time].rename("baseline_time")
+    )
+    df = df.join(baseline, on=list(by))
+    df["speedup"] = df.baseline_time / df[time]
+    df["efficiency"] = df.speedup / df.threads
+    # e = (1/S - 1/p) / (1 - 1/p), undefined for a single thread
+    p = df.threads.where(df.threads > 1)
+    df["serial_fraction"] = (1 / df.speedup - 1 / p) / (1 - 1 / p)
+    df["serial_fraction"] = df.serial_fraction.replace([np.inf, -np.inf], np.nan)
+    return df.drop(columns="baseline_time")
+
+
+def dataset_size(datadir, tables, layout="flat"):
+    size = {"input_bytes": 0, "input_rows": 0}
+    for table in tables:
+        files = sorted(table_dir(datadir, table, layout).rglob("*.parquet"))
+        rows = sum(pq.ParquetFile(f).metadata.num_rows for f in files)
+        size[f"{table}_rows"] = rows
+        size["input_rows"] += rows
+        size["input_bytes"] += sum(f.stat().st_size for f in files)
+    return size
+
+
+def slope(x, y):
+    ok = np.isfinite(x) & np.isfinite(y)
+    if len(np.unique(x[ok])) < 2:
+        return np.nan
+    return np.polyfit(x[ok], y[ok], 1)[0]
+
+
+def data_scaling(df, time="time_median", by=("db", "name")):
+    """Add throughput per run and, per engine, the growth of peak memory with
+    input size and the exponent of run time in the number of input rows,
+    above 1 the engine scales superlinearly."""
+    # failed runs have no times, there are no time columns when all failed
+    df = df.reindex(
+        columns=df.columns.union([time, "max_memory_usage"], sort=False)
+    )
+    df["rows_per_s"] = df.input_rows / df[time]
+    df["bytes_per_s"] = df.input_bytes / df[time]
+    fits = {}
+    for key, group in df.groupby(list(by)):
+        fits[key] = {
+            "memory_mib_per_gib": slope(
+                group.input_bytes.to_numpy() / GIB,
+                group.max_memory_usage.to_numpy(dtype=float),
+            ),
+            "time_exponent": slope(
+                np.log(group.input_rows.to_numpy(dtype=float)),
+                np.log(group[time].to_numpy(dtype=float)),
+            ),
+        }
+    return df.join(pd.DataFrame.from_dict(fits, orient="index"), on=list(by))
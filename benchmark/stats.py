@@ -0,0 +1,145 @@
+import functools
+import math
+import statistics
+
+# two sided 95% quantiles of the student t distribution by degrees of freedom
+T_95 = {
+    1: 12.706,
+    2: 4.303,
+    3: 3.182,
+    4: 2.776,
+    5: 2.571,
+    6: 2.447,
+    7: 2.365,
+    8: 2.306,
+    9: 2.262,
+    10: 2.228,
+    12: 2.179,
+    15: 2.131,
+    20: 2.086,
+    25: 2.060,
+    30: 2.042,
+    40: 2.021,
+    60: 2.000,
+    120: 1.980,
+}
+
+
+def t_quantile(df):
+    if df > max(T_95):
+        return 1.960
+    # rounding the degrees of freedom down keeps the interval conservative
+    return T_95[max(k for k in T_95 if k <= df)]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def reject_outliers(samples, k=1.5):
+    # Tukey's fences, too few samples to estimate the quartiles keeps them all
+    if len(samples) < 4:
+        return list(samples), []
+    q1, _, q3 = statistics.quantiles(samples, n=4)
+    low, high = q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+    kept = [s for s in samples if low <= s <= high]
+    rejected = [s for s in samples if not low <= s <= high]
+    return kept, rejected
+
+
+def relative_ci(samples):
+    if len(samples) < 2:
+        return math.inf
+    mean = statistics.mean(samples)
+    if mean == 0:
+        return 0.0
+    half_width = t_quantile(len(samples) - 1) * statistics.stdev(samples)
+    return half_width / math.sqrt(len(samples)) / mean
+
+
+def summarize(samples, prefix="time"):
+    kept, rejected = reject_outliers(samples)
+    return {
+        f"{prefix}_runs": len(samples),
+        f"{prefix}_outliers": len(rejected),
+        f"{prefix}_median": statistics.median(kept),
+        f"{prefix}_mean": statistics.mean(kept),
+        f"{prefix}_p95": percentile(kept, 95),
+        f"{prefix}_stddev": statistics.stdev(kept) if len(kept) > 1 else 0.0,
+        f"{prefix}_min": min(kept),
+        f"{prefix}_max": max(kept),
+        f"{prefix}_relative_ci": relative_ci(kept),
+    }
+
+
+def measure(
+    run_once, key, warmups=0, min_runs=1, max_runs=1, target_ci=0.05, failed=None
+):
+    """Call ``run_once`` until the 95% confidence interval of ``key`` over the
+    runs that are not outliers is within ``target_ci`` of the mean, or
+    ``max_runs`` is reached. Warm-up results are discarded. A result for which
+    ``failed`` is true ends the measurement and is returned last."""
+    failed = failed or (lambda result: False)
+    for _ in range(warmups):
+        result = run_once()
+        if failed(result):
+            return [result]
+    results = []
+    while len(results) < max(min_runs, max_runs):
+        results.append(run_once())
+        if failed(results[-1]):
+            break
+        if len(results) >= min_runs:
+            kept, _ = reject_outliers([key(r) for r in results])
+            if relative_ci(kept) <= target_ci:
+                break
+    return results
+
+
+def representative(results, key):
+    """The run whose ``key`` is closest to the median of all runs."""
+    median = statistics.median(key(r) for r in results)
+    return min(results, key=lambda r: abs(key(r) - median))
+
+
+# exact null distributions are enumerated up to this many samples in total
+EXACT_SAMPLES = 20
+
+
+@functools.lru_cache(maxsize=None)
+def u_counts(n1, n2):
+    """Number of orderings of n1 + n2 distinct samples by the count of pairs
+    in which the second sample is larger."""
+    if n1 == 0 or n2 == 0:
+        return (1,)
+    # the largest sample is either from the second group and beats all of
+    # the first group, or from the first group and beats none
+    counts = [0] * (n1 * n2 + 1)
+    for u, c in enumerate(u_counts(n1, n2 - 1)):
+        counts[u + n1] += c
+    for u, c in enumerate(u_counts(n1 - 1, n2)):
+        counts[u] += c
+    return tuple(counts)
+
+
+def mann_whitney(a, b):
+    """One sided p-value of the Mann-Whitney U test that samples ``b`` tend to
+    be larger than samples ``a``."""
+    n1, n2 = len(a), len(b)
+    u = sum(1.0 if y > x else 0.5 if y == x else 0.0 for x in a for y in b)
+    values = list(a) + list(b)
+    ties = [values.count(v) for v in set(values)]
+    if n1 + n2 <= EXACT_SAMPLES and all(t == 1 for t in ties):
+        counts = u_counts(n1, n2)
+        return sum(counts[math.ceil(u):]) / math.comb(n1 + n2, n1)
+    n = n1 + n2
+    variance = n1 * n2 / 12 * (n + 1 - sum(t**3 - t for t in ties) / (n * (n - 1)))
+    if variance == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
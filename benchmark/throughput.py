@@ -0,0 +1,51 @@
+import random
+
+import pandas as pd
+
+from benchmark.stats import percentile
+
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+
+def stream_orders(queries, streams, seed=0):
+    """Query order of every stream, the first in the given order like the
+    power test and the others in a seeded random permutation."""
+    orders = [list(queries)]
+    for stream in range(1, streams):
+        orders.append(random.Random(seed + stream).sample(queries, len(queries)))
+    return orders
+
+
+def latency_stats(latencies):
+    stats = {
+        "queries": len(latencies),
+        "latency_mean": sum(latencies) / len(latencies),
+        "latency_max": max(latencies),
+    }
+    for p in LATENCY_PERCENTILES:
+        stats[f"latency_p{p}"] = percentile(latencies, p)
+    return stats
+
+
+def throughput(queries, elapsed, cpu_time, cpu_count):
+    """Rows of latency statistics per query and over all queries, with the
+    queries per hour and the share of the machine's cpu time the streams
+    used."""
+    queries = pd.DataFrame(queries)
+    done = queries[~queries.failed]
+    rows = [
+        {"name": name, **latency_stats(group.latency.tolist())}
+        for name, group in done.groupby("name")
+    ]
+    if len(done):
+        rows.append({"name": "all", **latency_stats(done.latency.tolist())})
+    return [
+        {
+            **row,
+            "failed_queries": int(queries.failed.sum()),
+            "elapsed": elapsed,
+            "queries_per_hour": len(done) * 3600 / elapsed,
+            "cpu_utilization": cpu_time / (elapsed * cpu_count),
+        }
+        for row in rows
+    ]
@@ -1,14 +1,28 @@
 import glob
+import itertools
+import multiprocessing
+import os
+import shutil
 import sys
-import tarfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
 import click
 import dask.bag as db
+import numpy as np
+import psutil
 import pyarrow
+import pyarrow.compute as pac
 import pyarrow.csv as pc
+import pyarrow.dataset as ds
+import pyarrow.ipc
 import pyarrow.parquet as pq
-import wget
+from dask.utils import parse_bytes
+
+from benchmark.download import download_and_extract
+from benchmark.fanniemae_lookup import build_lookup
+from benchmark.layout import LAYOUTS, partitioning, table_dir
+from benchmark.memory import peak_rss
 
 LINKS = {
     "1": "http://rapidsai-data.s3-website.us-east-2.amazonaws.com/notebook-mortgage-data/mortgage_2000.tgz",
@@ -19,8 +33,397 @@ LINKS = {
     "17": "http://rapidsai-data.s3-website.us-east-2.amazonaws.com/notebook-mortgage-data/mortgage_2000-2016.tgz",
 }
 
+COMPRESSIONS = ["snappy", "zstd", "lz4", "gzip", "none"]
+PROFILES = ["raw", "typed"]
+DATE = pyarrow.date32()
+CATEGORY = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
+PERFORMANCE_DATES = [
+    "monthly_reporting_period",
+    "maturity_date",
+    "zero_balance_effective_date",
+    "last_paid_installment_date",
+    "foreclosed_after",
+    "disposition_date",
+]
+PERFORMANCE_CATEGORIES = [
+    "servicer",
+    "mod_flag",
+    "zero_balance_code",
+    "repurchase_make_whole_proceeds_flag",
+    "servicing_activity_indicator",
+]
+ACQUISITION_DATES = ["orig_date", "first_pay_date"]
+ACQUISITION_CATEGORIES = [
+    "orig_channel",
+    "seller_name",
+    "first_home_buyer",
+    "loan_purpose",
+    "property_type",
+    "occupancy_status",
+    "property_state",
+    "product_type",
+    "relocation_mortgage_indicator",
+]
+DEFAULT_WORKER_MEMORY = "1GB"
+# measured peak rss of a streaming conversion above the worker's own: up to
+# eight times the csv block for the decoded columns, the parsed dates and the
+# encoded row group, plus a fixed part
+STREAMING_MEMORY_FACTOR = 8
+STREAMING_MEMORY_OVERHEAD = 128 << 20
+MIN_BLOCK_SIZE = 1 << 20
+# sorting keeps a sorted copy of the block and its decoded dictionaries
+SORTING_MEMORY_FACTOR = 12
+SORTED_BATCH_ROWS = 1 << 18
+# rows per batch of a sorted run and the most runs merged at once
+RUN_BATCH_ROWS = 1 << 10
+MAX_MERGE_FAN_IN = 256
+
+
+def convert_to_parquet(
+    f,
+    columns,
+    table,
+    streaming=False,
+    worker_memory=None,
+    layout="flat",
+    row_group_size=None,
+    sort_by_loan_id=False,
+    delete_source=False,
+    **parquet_options,
+):
+    factor = SORTING_MEMORY_FACTOR if sort_by_loan_id else STREAMING_MEMORY_FACTOR
+    schema, chunks = read_csv_chunks(f, columns, streaming, worker_memory, factor)
+    if sort_by_loan_id:
+        chunks = sort_by_loan_id_chunks(f, schema, chunks, streaming, row_group_size)
+        if not streaming and layout == "flat" and row_group_size is None:
+            # the min/max statistics of smaller row groups can skip loan ids,
+            # a single one of the whole file cannot
+            row_group_size = SORTED_BATCH_ROWS
+    if layout == "hive":
+        outfile = write_hive(
+            f,
+            table,
+            schema,
+            chunks,
+            row_group_size,
+            preserve_order=sort_by_loan_id,
+            **parquet_options,
+        )
+    else:
+        outfile = write_flat(f, schema, chunks, row_group_size, **parquet_options)
+    if delete_source:
+        f.unlink()
+    if streaming and peak_rss() > parse_bytes(worker_memory or DEFAULT_WORKER_MEMORY):
+        click.echo(
+            f"warning: converting {f.name} peaked at {peak_rss() >> 20}MiB, "
+            f"above --worker-memory {worker_memory or DEFAULT_WORKER_MEMORY}",
+            err=True,
+        )
+    return outfile
+
+
+def read_csv_chunks(
+    f, columns, streaming=False, worker_memory=None, factor=STREAMING_MEMORY_FACTOR
+):
+    # dates are parsed after reading since the csv reader cannot handle the
+    # month only MM/YYYY format
+    csv_types = {
+        name: pyarrow.string() if type_ == DATE else type_
+        for name, type_ in columns.items()
+    }
+    schema = pyarrow.schema(list(columns.items()))
+    convert_options = pc.ConvertOptions(column_types=csv_types)
+    parse_options = pc.ParseOptions(delimiter="|")
+    if not streaming:
+        read_options = pc.ReadOptions(column_names=columns.keys())
+        data = pc.read_csv(
+            f,
+            convert_options=convert_options,
+            parse_options=parse_options,
+            read_options=read_options,
+        )
+        return schema, [parse_dates(data, columns)]
+
+    # the streaming csv reader reads up to 32 blocks ahead, so the file is
+    # cut into blocks here and each is parsed on its own
+    read_options = pc.ReadOptions(column_names=columns.keys(), use_threads=False)
+    return schema, (
+        parse_dates(
+            pc.read_csv(
+                pyarrow.py_buffer(block),
+                convert_options=convert_options,
+                parse_options=parse_options,
+                read_options=read_options,
+            ),
+            columns,
+        )
+        for block in csv_blocks(f, streaming_block_size(worker_memory, factor))
+    )
+
+
+def csv_blocks(f, block_size):
+    """Views of up to ``block_size`` bytes of ``f`` cut after the last line
+    break, the files have no quoted values so a line break always ends a row.
+    Every view is of the same buffer and only valid until the next one."""
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    filled = 0
+    with open(f, "rb", buffering=0) as source:
+        while True:
+            read = source.readinto(view[filled:])
+            filled += read
+            end = buffer.rfind(b"\n", 0, filled) + 1 if read else filled
+            if not end and filled:
+                raise ValueError(f"a line of {f} is longer than {block_size} bytes")
+            if end:
+                yield view[:end]
+            view[: filled - end] = view[end:filled]
+            filled -= end
+            if not read:
+                break
+
+
+def parse_dates(data, columns):
+    for i, (name, type_) in enumerate(columns.items()):
+        if type_ != DATE:
+            continue
+        # MM/YYYY becomes MM/01/YYYY, empty strings become nulls
+        dates = pac.replace_substring_regex(
+            data.column(i), pattern=r"^(\d{2})/(\d{4})$", replacement=r"\1/01/\2"
+        )
+        dates = pac.strptime(dates, format="%m/%d/%Y", unit="s", error_is_null=True)
+        data = data.set_column(i, name, pac.cast(dates, DATE))
+    return data
+
+
+def apply_profile(columns, profile, dates, categories):
+    if profile == "typed":
+        columns.update({name: DATE for name in dates})
+        columns.update({name: CATEGORY for name in categories})
+    return columns
+
+
+def sort_by_loan_id_chunks(f, schema, chunks, streaming=False, row_group_size=None):
+    if not streaming:
+        for chunk in chunks:
+            yield chunk.sort_by("loan_id")
+        return
+
+    # an external merge sort: every chunk is sorted into a run file next to
+    # the input, and the runs are merged a few batches at a time
+    run_dir = f.parent / f".{f.name}.sort"
+    run_dir.mkdir(exist_ok=True)
+    try:
+        runs, chunk_rows = sort_runs(run_dir, schema, chunks)
+        # the row groups are held twice while they are written, the largest
+        # ones only where the memory for a chunk allows them
+        rows = row_group_size or min(SORTED_BATCH_ROWS, 2 * chunk_rows)
+        merged = merge_all(run_dir, runs, run_schema(schema), chunk_rows)
+        yield from rechunk((restore_types(t, schema) for t in merged), rows)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def run_schema(schema):
+    # a stream of sorted batches would need a new dictionary for every batch,
+    # so the runs keep the dictionary columns decoded
+    return pyarrow.schema(
+        [
+            pyarrow.field(f.name, f.type.value_type)
+            if pyarrow.types.is_dictionary(f.type)
+            else f
+            for f in schema
+        ]
+    )
+
+
+def write_run(path, schema, tables):
+    with pyarrow.ipc.new_stream(path, schema) as writer:
+        for table in tables:
+            writer.write_table(table.cast(schema), max_chunksize=RUN_BATCH_ROWS)
+    return path
+
+
+def read_run(path):
+    with pyarrow.OSFile(str(path)) as source:
+        for batch in pyarrow.ipc.open_stream(source):
+            if batch.num_rows:
+                yield batch
+
+
+def sort_key(batch):
+    # missing loan ids sort last, like in sort_by
+    ids = batch.column("loan_id")
+    last = np.inf if pyarrow.types.is_floating(ids.type) else np.iinfo(np.int64).max
+    return pac.fill_null(ids, last).to_numpy()
+
+
+def merge_runs(runs, schema):
+    """Sorted tables of the rows of the sorted ``runs``. Every step takes
+    the rows of each run up to the smallest last loan id of their current
+    batches, no run has rows below that left."""
+    readers = [read_run(run) for run in runs]
+    current = [next(reader, None) for reader in readers]
+    while True:
+        live = [i for i, batch in enumerate(current) if batch is not None]
+        if not live:
+            return
+        bound = min(sort_key(current[i])[-1] for i in live)
+        taken = []
+        for i in live:
+            batch = current[i]
+            n = int(np.searchsorted(sort_key(batch), bound, side="right"))
+            taken.append(batch.slice(0, n))
+            current[i] = next(readers[i], None) if n == batch.num_rows else batch.slice(n)
+        yield pyarrow.Table.from_batches(taken, schema).sort_by("loan_id")
+
+
+def sort_runs(run_dir, schema, chunks):
+    schema = run_schema(schema)
+    runs = []
+    chunk_rows = 0
+    for chunk in chunks:
+        if chunk.num_rows:
+            path = run_dir / f"run-{len(runs):06d}.arrow"
+            runs.append(write_run(path, schema, [chunk.sort_by("loan_id")]))
+            chunk_rows = max(chunk_rows, chunk.num_rows)
+    return runs, chunk_rows
+
+
+def merge_all(run_dir, runs, schema, chunk_rows):
+    # the current batches of the merged runs take about as much memory as a
+    # chunk, more runs are merged in several passes
+    fan_in = min(max(chunk_rows // RUN_BATCH_ROWS, 2), MAX_MERGE_FAN_IN)
+    for merge_pass in itertools.count():
+        if len(runs) <= fan_in:
+            break
+        merged = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start : start + fan_in]
+            path = run_dir / f"merge-{merge_pass}-{len(merged):06d}.arrow"
+            merged.append(write_run(path, schema, merge_runs(group, schema)))
+            for run in group:
+                run.unlink()
+        runs = merged
+    return merge_runs(runs, schema)
+
+
+def rechunk(tables, rows):
+    # merge steps vary in size, the row groups do not
+    pending = []
+    pending_rows = 0
+    for table in tables:
+        pending.append(table)
+        pending_rows += table.num_rows
+        if pending_rows >= rows:
+            data = pyarrow.concat_tables(pending)
+            full = pending_rows - pending_rows % rows
+            for start in range(0, full, rows):
+                yield data.slice(start, rows)
+            pending = [data.slice(full)]
+            pending_rows -= full
+    if pending_rows:
+        yield pyarrow.concat_tables(pending)
+
+
+def restore_types(data, schema):
+    for i, field in enumerate(schema):
+        column = data.column(i)
+        if column.type == field.type:
+            continue
+        if pyarrow.types.is_dictionary(field.type):
+            column = pac.dictionary_encode(column)
+        data = data.set_column(i, field, pac.cast(column, field.type))
+    return data
+
+
+def write_flat(f, schema, chunks, row_group_size=None, **parquet_options):
+    outfile = f.parent / (f.name + ".parquet")
+    with pq.ParquetWriter(outfile, schema, **parquet_options) as writer:
+        for chunk in chunks:
+            writer.write_table(chunk, row_group_size=row_group_size)
+    return outfile
+
+
+def write_hive(
+    f,
+    table,
+    schema,
+    chunks,
+    row_group_size=None,
+    preserve_order=False,
+    **parquet_options,
+):
+    outdir = table_dir(f.parent.parent, table, layout="hive")
+    partitions = partitioning(table)
+    add_partitions = PARTITION_COLUMNS[table]
+
+    def batches():
+        for chunk in chunks:
+            for name, column in add_partitions(chunk).items():
+                chunk = chunk.append_column(name, column)
+            yield from chunk.to_batches()
+
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        batches(),
+        outdir,
+        schema=pyarrow.unify_schemas([schema, partitions]),
+        format=file_format,
+        file_options=file_format.make_write_options(**parquet_options),
+        partitioning=ds.partitioning(partitions, flavor="hive"),
+        basename_template=f"{f.name}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        use_threads=not preserve_order,
+        min_rows_per_group=row_group_size or 0,
+        max_rows_per_group=row_group_size or 1 << 20,
+    )
+    return outdir
+
+
+def year_and_month(dates):
+    if pyarrow.types.is_date(dates.type):
+        year, month = pac.year(dates), pac.month(dates)
+    else:
+        year = pac.utf8_slice_codeunits(dates, -4)
+        month = pac.utf8_slice_codeunits(dates, 0, 2)
+    return pac.cast(year, pyarrow.int16()), pac.cast(month, pyarrow.int8())
+
+
+def performance_partitions(data):
+    year, month = year_and_month(data.column("monthly_reporting_period"))
+    return {
+        "reporting_year": year,
+        "reporting_quarter": pac.add(pac.divide(pac.subtract(month, 1), 3), 1),
+    }
+
+
+def acquisition_partitions(data):
+    year, _ = year_and_month(data.column("orig_date"))
+    return {"orig_year": year}
+
+
+PARTITION_COLUMNS = {
+    "perf": performance_partitions,
+    "acq": acquisition_partitions,
+}
+
 
-def convert_performance_to_parquet(f, with_id_as_float64):
+def streaming_block_size(worker_memory, factor=STREAMING_MEMORY_FACTOR):
+    # the block is sized from what the worker has left below the ceiling, the
+    # interpreter with its libraries already takes over 100MB of it
+    if worker_memory is None:
+        worker_memory = DEFAULT_WORKER_MEMORY
+    if isinstance(worker_memory, str):
+        worker_memory = parse_bytes(worker_memory)
+    headroom = (
+        worker_memory - psutil.Process().memory_info().rss - STREAMING_MEMORY_OVERHEAD
+    )
+    return max(headroom // factor, MIN_BLOCK_SIZE)
+
+
+def convert_performance_to_parquet(f, with_id_as_float64, profile="raw", **kwargs):
     columns = {
         "loan_id": pyarrow.float64() if with_id_as_float64 else pyarrow.int64(),
         "monthly_reporting_period": pyarrow.string(),
@@ -54,20 +457,13 @@ def convert_performance_to_parquet(f, with_id_as_float64):
         "foreclosure_principal_write_off_amount": pyarrow.string(),
         "servicing_activity_indicator": pyarrow.string(),
     }
-    cvs_options = pc.ConvertOptions(column_types=columns)
-    parse_options = pc.ParseOptions(delimiter="|")
-    read_options = pc.ReadOptions(column_names=columns.keys())
-    data = pc.read_csv(
-        f,
-        convert_options=cvs_options,
-        parse_options=parse_options,
-        read_options=read_options,
+    columns = apply_profile(
+        columns, profile, PERFORMANCE_DATES, PERFORMANCE_CATEGORIES
     )
-    outfile = f.parent / (f.name + ".parquet")
-    pq.write_table(data, outfile)
+    return convert_to_parquet(f, columns, "perf", **kwargs)
 
 
-def convert_acquisition_to_parquet(f, with_id_as_float64):
+def convert_acquisition_to_parquet(f, with_id_as_float64, profile="raw", **kwargs):
     columns = {
         "loan_id": pyarrow.float64() if with_id_as_float64 else pyarrow.int64(),
         "orig_channel": pyarrow.string(),
@@ -96,18 +492,42 @@ def convert_acquisition_to_parquet(f, with_id_as_float64):
         "relocation_mortgage_indicator": pyarrow.string(),
         "dummy": pyarrow.string(),
     }
-
-    cvs_options = pc.ConvertOptions(column_types=columns)
-    read_options = pc.ReadOptions(column_names=columns.keys())
-    parse_options = pc.ParseOptions(delimiter="|")
-    data = pc.read_csv(
-        f,
-        convert_options=cvs_options,
-        parse_options=parse_options,
-        read_options=read_options,
+    columns = apply_profile(
+        columns, profile, ACQUISITION_DATES, ACQUISITION_CATEGORIES
     )
-    outfile = f.parent / (f.name + ".parquet")
-    pq.write_table(data, outfile)
+    return convert_to_parquet(f, columns, "acq", **kwargs)
+
+
+CONVERTERS = {
+    "perf": convert_performance_to_parquet,
+    "acq": convert_acquisition_to_parquet,
+}
+
+
+def download_and_convert(link, datadir, workers, download_options, *args, **kwargs):
+    # every extracted member is converted right away on a pool shared by perf
+    # and acq, extraction pauses while too many conversions are queued
+    written = {table: 0 for table in CONVERTERS}
+    pending = set()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+
+        def submit(f):
+            table = f.parent.name
+            if table not in CONVERTERS or ".txt" not in f.name:
+                return
+            while len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                pending.difference_update(done)
+            pending.add(pool.submit(CONVERTERS[table], f, *args, **kwargs))
+            written[table] += 1
+
+        download_and_extract(link, datadir, on_member=submit, **download_options)
+        for future in pending:
+            future.result()
+    return written
 
 
 def bar_custom(current, total, width=80):
@@ -127,37 +547,180 @@ def bar_custom(current, total, width=80):
     help="Number of years of fannie mae data to download",
 )
 @click.option("--datadir", type=str, help="directory to download the data")
-def main(years, datadir, with_id_as_float64):
+@click.option(
+    "--streaming/--no-streaming",
+    default=False,
+    show_default=True,
+    help="Convert files in record batches instead of loading them whole",
+)
+@click.option(
+    "--worker-memory",
+    default=DEFAULT_WORKER_MEMORY,
+    show_default=True,
+    help="Memory ceiling per conversion worker in streaming mode e.g. 512MB, "
+    "including the about 150MB of the interpreter itself",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(LAYOUTS),
+    default="flat",
+    show_default=True,
+    help="flat writes one parquet file per input, hive partitions perf by "
+    "reporting year/quarter and acq by origination year",
+)
+@click.option(
+    "--row-group-size",
+    type=int,
+    default=None,
+    help="Maximum number of rows per parquet row group",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(COMPRESSIONS),
+    default="snappy",
+    show_default=True,
+    help="Parquet compression codec",
+)
+@click.option(
+    "--dictionary/--no-dictionary",
+    default=True,
+    show_default=True,
+    help="Dictionary encode parquet columns",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(PROFILES),
+    default="raw",
+    show_default=True,
+    help="raw keeps dates and codes as strings, typed stores dates as date32 "
+    "and low cardinality codes as dictionaries",
+)
+@click.option(
+    "--sort-by-loan-id/--no-sort-by-loan-id",
+    default=False,
+    show_default=True,
+    help="Cluster perf and acq rows by loan_id so row group min/max statistics "
+    "allow range pruned and sorted merge joins",
+)
+@click.option(
+    "--connections",
+    default=8,
+    show_default=True,
+    help="Number of parallel ranged requests used for the download",
+)
+@click.option(
+    "--checksum",
+    default=None,
+    help="Expected checksum of the archive e.g. sha256:<hex>. It is verified "
+    "once the download finished, after the members were extracted and with "
+    "--pipeline converted",
+)
+@click.option(
+    "--pipeline/--no-pipeline",
+    default=False,
+    show_default=True,
+    help="Convert every file as soon as it is extracted on one worker pool "
+    "shared by perf and acq",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of conversion workers in pipeline mode  [default: cpu count]",
+)
+@click.option(
+    "--delete-txt/--keep-txt",
+    default=False,
+    show_default=True,
+    help="Delete extracted text files once they are converted",
+)
+@click.option(
+    "--lookup/--no-lookup",
+    default=False,
+    show_default=True,
+    help="Build the loan_id indexed acquisition lookup used by the lookup "
+    "engine of run.py",
+)
+def main(
+    years,
+    datadir,
+    with_id_as_float64,
+    streaming,
+    worker_memory,
+    layout,
+    row_group_size,
+    compression,
+    dictionary,
+    profile,
+    sort_by_loan_id,
+    connections,
+    checksum,
+    pipeline,
+    workers,
+    delete_txt,
+    lookup,
+):
     link = LINKS[years]
-    click.echo("Downloading\u2026")
     Path(datadir).mkdir(parents=True, exist_ok=True)
-    wget.download(link, datadir, bar=bar_custom)
-    click.echo("\nExtracting\u2026")
-    tar = tarfile.open(Path(datadir) / link.split("/")[-1])
-    tar.extractall(datadir)
-    tar.close()
-    click.echo("Converting\u2026")
-    extracted_files = (Path(datadir) / "perf").glob("*.txt*")
-    result = (
-        db.from_sequence(extracted_files)
-        .map(
-            convert_performance_to_parquet,
+    download_options = dict(
+        connections=connections,
+        checksum=checksum,
+        progress=bar_custom,
+    )
+    conversion = dict(
+        profile=profile,
+        streaming=streaming,
+        worker_memory=worker_memory,
+        layout=layout,
+        row_group_size=row_group_size,
+        compression=compression,
+        use_dictionary=dictionary,
+        sort_by_loan_id=sort_by_loan_id,
+        delete_source=delete_txt,
+    )
+    if pipeline:
+        click.echo("Downloading, extracting and converting\u2026")
+        written = download_and_convert(
+            link,
+            datadir,
+            workers or os.cpu_count(),
+            download_options,
             with_id_as_float64,
+            **conversion,
         )
-        .compute()
-    )
-    click.echo(f"Writen {len(result)} performance parquet files")
+        click.echo(f"\nWriten {written['perf']} performance parquet files")
+        click.echo(f"Writen {written['acq']} acquisitions parquet files")
+    else:
+        click.echo("Downloading and extracting\u2026")
+        download_and_extract(link, datadir, **download_options)
+        click.echo("\nConverting\u2026")
+        extracted_files = (Path(datadir) / "perf").glob("*.txt*")
+        result = (
+            db.from_sequence(extracted_files)
+            .map(
+                convert_performance_to_parquet,
+                with_id_as_float64,
+                **conversion,
+            )
+            .compute()
+        )
+        click.echo(f"Writen {len(result)} performance parquet files")
 
-    extracted_files = (Path(datadir) / "acq").glob("*.txt*")
-    result = (
-        db.from_sequence(extracted_files)
-        .map(
-            convert_acquisition_to_parquet,
-            with_id_as_float64,
+        extracted_files = (Path(datadir) / "acq").glob("*.txt*")
+        result = (
+            db.from_sequence(extracted_files)
+            .map(
+                convert_acquisition_to_parquet,
+                with_id_as_float64,
+                **conversion,
+            )
+            .compute()
         )
-        .compute()
-    )
-    click.echo(f"Writen {len(result)} acquisitions parquet files")
+        click.echo(f"Writen {len(result)} acquisitions parquet files")
+
+    if lookup:
+        loans = build_lookup(datadir, layout)
+        click.echo(f"Writen acquisition lookup of {loans} loans")
     click.echo("\n")
 
 
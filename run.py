@@ -1,28 +1,55 @@
 import datetime
+import gc
 import itertools
 import json
 import multiprocessing
 import os
 import platform
 import sys
+import threading
 import time
 import timeit
 import traceback
 import warnings
+from contextlib import nullcontext
 from pathlib import Path
 from shutil import which
 
 import click
 import duckdb
 import ibis
+from dask.utils import parse_bytes
+from datafusion import RuntimeConfig, SessionConfig, SessionContext
 import pandas as pd
 import psutil
+import pyarrow
 from jinja2 import Template
-from memory_profiler import memory_usage
 
+from benchmark import (
+    fanniemae_arrow,
+    fanniemae_dask,
+    fanniemae_incremental,
+    fanniemae_lookup,
+    fanniemae_polars,
+)
 from benchmark.fanniemae_summary import summary_query
+from benchmark.layout import LAYOUTS, table_dir, table_glob
+from benchmark.memory import MIB, MemorySampler, SpillSampler, peak_rss
+from benchmark.pagecache import dataset_files, evict
+from benchmark.scaling import data_scaling, dataset_size, thread_counts, thread_scaling
+from benchmark.profile import EXTENSIONS, PROFILERS, TOP_OPERATORS, profile_query
 from benchmark.powercap_rapl import PowercapRaplProfiler
 from benchmark.powermetrics import PowerMetricsProfiler
+from benchmark.result_cache import ResultCache, query_text, write_result
+from benchmark.results import (
+    compare_runs,
+    dataset_fingerprint,
+    load_runs,
+    save_run,
+    select_run,
+)
+from benchmark.stats import measure, representative, summarize
+from benchmark.throughput import stream_orders, throughput
 
 warnings.filterwarnings("ignore")
 # Fix
@@ -31,7 +58,78 @@ sys.path.append("tpc-queries")
 from ibis_tpc import (h01, h02, h03, h04, h05, h06, h07, h08, h09, h10, h11,
                       h12, h13, h14, h15, h16, h17, h18, h19, h20, h21, h22)
 
-BACKENDS = {"datafusion": ibis.datafusion.connect(), "duckdb": ibis.duckdb.connect()}
+def connect_duckdb(threads, memory_limit=None, temp_dir=None):
+    config = {"threads": threads}
+    if memory_limit is not None:
+        config["memory_limit"] = memory_limit
+    return ibis.duckdb.connect(temp_directory=temp_dir, **config)
+
+
+def connect_datafusion(threads, memory_limit=None, temp_dir=None):
+    runtime = RuntimeConfig()
+    if memory_limit is not None:
+        runtime = runtime.with_fair_spill_pool(parse_bytes(memory_limit))
+    if temp_dir is not None:
+        Path(temp_dir).mkdir(parents=True, exist_ok=True)
+        runtime = runtime.with_disk_manager_specified([str(temp_dir)])
+    db = ibis.datafusion.connect()
+    # ibis 5 cannot be handed a SessionContext, so the configured one is swapped in
+    db._context = SessionContext(
+        SessionConfig().with_target_partitions(threads), runtime
+    )
+    return db
+
+
+def connect_polars(threads, memory_limit=None, temp_dir=None):
+    return fanniemae_polars.Backend(threads)
+
+
+def connect_pyarrow(threads, memory_limit=None, temp_dir=None):
+    return fanniemae_arrow.Backend(threads)
+
+
+def connect_lookup(threads, memory_limit=None, temp_dir=None):
+    return fanniemae_lookup.Backend(threads)
+
+
+def connect_incremental(threads, memory_limit=None, temp_dir=None):
+    return fanniemae_incremental.Backend(threads)
+
+
+def connect_dask(threads, memory_limit=None, temp_dir=None):
+    return fanniemae_dask.Backend(threads)
+
+
+BACKENDS = {
+    "datafusion": connect_datafusion,
+    "duckdb": connect_duckdb,
+    "polars": connect_polars,
+    "pyarrow": connect_pyarrow,
+    "lookup": connect_lookup,
+    "incremental": connect_incremental,
+    "dask": connect_dask,
+}
+# engines that run the ibis expressions, the tpch queries need one of these
+IBIS_ENGINES = ["datafusion", "duckdb"]
+# engines that apply --memory-limit, the others run unbounded
+MEMORY_LIMIT_ENGINES = ["datafusion", "duckdb"]
+
+# the warm connection with registered tables keyed by (catalog, engine,
+# datadir, threads, layout, materialize, memory_limit, temp_dir, shards,
+# scheduler), reused across queries and repeats until a sweep moves on
+SESSIONS = {}
+
+TPCH_TABLES = [
+    "customer",
+    "lineitem",
+    "nation",
+    "orders",
+    "part",
+    "partsupp",
+    "region",
+    "supplier",
+]
+FANNIE_TABLES = ["perf", "acq"]
 
 QUERIES_TPCH = {
     "h01": h01.tpc_h01,
@@ -57,45 +155,214 @@ QUERIES_TPCH = {
     "h21": h21.tpc_h21,
     "h22": h22.tpc_h22,
 }
-class Process(multiprocessing.Process):
+class QueryProcess:
     def __init__(self, *args, **kwargs):
-        multiprocessing.Process.__init__(self, *args, **kwargs)
+        super().__init__(*args, **kwargs)
         self._pconn, self._cconn = multiprocessing.Pipe()
-        self._exception = None
+        self._message = None
 
     def run(self):
         try:
-            multiprocessing.Process.run(self)
-            self._cconn.send(None)
+            result = self._target(*self._args, **self._kwargs)
+            self._cconn.send((result, None))
         except Exception as e:
             tb = traceback.format_exc()
-            self._cconn.send((e, tb))
+            # the exception itself may not be picklable
+            self._cconn.send((None, (repr(e), tb)))
+
+    def _receive(self):
+        if self._message is None and self._pconn.poll():
+            self._message = self._pconn.recv()
+        return self._message or (None, None)
+
+    @property
+    def result(self):
+        return self._receive()[0]
 
     @property
     def exception(self):
-        if self._pconn.poll():
-            self._exception = self._pconn.recv()
-        return self._exception
-
-def setup_tpch_db(datadir, engine="duckdb", threads=8):
-    db = BACKENDS.get(engine)
-    tables = [
-        "customer",
-        "lineitem",
-        "nation",
-        "orders",
-        "part",
-        "partsupp",
-        "region",
-        "supplier"
-    ]
-    for t in tables:
-        path = datadir/ "raw" / f"{t}.parquet"
-        db.register(f"{path}", t)
-    db.con.execute(f"PRAGMA threads={threads};")
+        return self._receive()[1]
+
+
+class Process(QueryProcess, multiprocessing.Process):
+    pass
+
+
+class SpawnProcess(QueryProcess, multiprocessing.get_context("spawn").Process):
+    def __init__(self, *args, environment=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.environment = environment or {}
+
+    def start(self):
+        # the fresh interpreter inherits the environment it is started with
+        saved = {name: os.environ.get(name) for name in self.environment}
+        os.environ.update(self.environment)
+        try:
+            super().start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name)
+                else:
+                    os.environ[name] = value
+
+
+def query_process(expression, *args):
+    # engines whose thread pools do not survive a fork ask for a fresh interpreter
+    if getattr(expression, "spawn", False):
+        return SpawnProcess(
+            target=execute,
+            args=(expression, *args),
+            environment=getattr(expression, "environment", None),
+        )
+    return Process(target=execute, args=(expression, *args))
+
+def tpch_source(datadir, table):
+    # a directory of files written by scripts/tpch.py, or a single file
+    path = datadir / "raw" / table
+    if path.exists():
+        return path
+    file = datadir / "raw" / f"{table}.parquet"
+    if not file.exists():
+        raise FileNotFoundError(
+            f"no {table} table, expected {path}/ or {file}, run scripts/tpch.py"
+        )
+    return file
+
+
+def register_tpch_tables(db, engine, datadir, layout="flat"):
+    for t in TPCH_TABLES:
+        path = tpch_source(datadir, t)
+        if path.is_file():
+            db.register(f"{path}", t)
+        elif engine == "datafusion":
+            db.read_parquet(f"{path}/", t)
+        else:
+            db.register(f"{path / '*.parquet'}", t)
+    return db
+
+
+def register_fannie_tables(db, engine, datadir, layout="flat"):
+    for table in FANNIE_TABLES:
+        if engine == "datafusion":
+            register_datafusion(db, datadir, table, layout)
+        elif layout == "flat":
+            db.register(f"{table_glob(datadir, table)}", table)
+        else:
+            path = table_glob(datadir, table, layout)
+            db.register(f"{path}", table, hive_partitioning=True)
+    if engine == "lookup":
+        db.register_lookup(fanniemae_lookup.lookup_dir(datadir))
+    if engine == "incremental":
+        db.register_state(fanniemae_incremental.state_dir(datadir) / layout)
     return db
 
 
+def register_datafusion(db, datadir, table, layout="flat"):
+    if layout == "flat":
+        path = table_glob(datadir, table)
+    else:
+        # datafusion exposes partition columns as dictionaries which ibis
+        # cannot map, so only the files below the table directory are listed
+        path = f"{table_dir(datadir, table, layout)}/"
+    # registered on the context, ibis cannot map the dictionary columns of
+    # --profile typed datasets either, those are cast to strings in a view
+    context = db._context
+    context.register_parquet(table, f"{path}")
+    schema = context.table(table).schema()
+    if not any(pyarrow.types.is_dictionary(f.type) for f in schema):
+        return
+    source = f"{table}_dictionary"
+    context.register_table(source, context.catalog().database().table(table))
+    context.deregister_table(table)
+    columns = ", ".join(
+        f'CAST("{f.name}" AS VARCHAR) AS "{f.name}"'
+        if pyarrow.types.is_dictionary(f.type)
+        else f'"{f.name}"'
+        for f in schema
+    )
+    context.sql(f'CREATE VIEW "{table}" AS SELECT {columns} FROM "{source}"')
+
+
+SUMMARY_QUERIES = {
+    "polars": fanniemae_polars.summary_query,
+    "pyarrow": fanniemae_arrow.summary_query,
+    "lookup": fanniemae_lookup.summary_query,
+    "incremental": fanniemae_incremental.summary_query,
+    "dask": fanniemae_dask.summary_query,
+}
+
+CATALOGS = {
+    "tpch": (register_tpch_tables, TPCH_TABLES),
+    "fanniemae": (register_fannie_tables, FANNIE_TABLES),
+}
+
+
+def materialize_tables(db, engine, tables):
+    for t in tables:
+        if engine == "duckdb":
+            db.con.execute(f'CREATE TABLE "{t}_native" AS SELECT * FROM "{t}"')
+            db.con.execute(f'DROP VIEW "{t}"')
+            db.con.execute(f'ALTER TABLE "{t}_native" RENAME TO "{t}"')
+        elif engine in ("polars", "pyarrow", "lookup", "incremental", "dask"):
+            db.materialize(t)
+        else:
+            context = db._context
+            partitions = context.table(t).collect_partitioned()
+            context.deregister_table(t)
+            context.register_record_batches(t, partitions)
+
+
+def release_sessions():
+    # runs are forked from this process, a session kept around would count
+    # towards the memory of every later run
+    SESSIONS.clear()
+    gc.collect()
+    pyarrow.default_memory_pool().release_unused()
+
+
+def get_session(
+    catalog,
+    engine,
+    datadir,
+    threads=8,
+    layout="flat",
+    materialize=False,
+    memory_limit=None,
+    temp_dir=None,
+    shards=None,
+    scheduler=None,
+):
+    key = (
+        catalog,
+        engine,
+        str(datadir),
+        threads,
+        layout,
+        materialize,
+        memory_limit,
+        temp_dir,
+        shards,
+        scheduler,
+    )
+    if key not in SESSIONS:
+        release_sessions()
+        register, tables = CATALOGS[catalog]
+        start_time = timeit.default_timer()
+        connection = BACKENDS[engine](threads, memory_limit, temp_dir)
+        if engine == "dask":
+            connection.use_cluster(shards, scheduler)
+        db = register(connection, engine, datadir, layout)
+        if materialize:
+            materialize_tables(db, engine, tables)
+        SESSIONS[key] = {
+            "db": db,
+            "setup_time": timeit.default_timer() - start_time,
+            "queries": 0,
+        }
+    return SESSIONS[key]
+
+
 def platform_info():
     return {
         "machine": platform.machine(),
@@ -147,89 +414,602 @@ def aggregate_power_stats(power_results):
     }
 
 
-def execute(expr):
+def pin_threads(cpus):
+    # engine thread pools may already exist, so every thread is pinned
+    for thread in psutil.Process().threads():
+        os.sched_setaffinity(thread.id, cpus)
+
+
+def execute(expr, cpus=None, store=None):
+    if cpus is not None:
+        pin_threads(cpus)
+    # runs in the child, cpu times cover every thread of the engine and the
+    # worker processes it started and waited for, e.g. dask's local workers
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    start_cpu = process.cpu_times()
+    start_time = timeit.default_timer()
     result = expr.execute()
-    return result
+    query_time = timeit.default_timer() - start_time
+    end_cpu = process.cpu_times()
+    cpu_user = (
+        end_cpu.user
+        + end_cpu.children_user
+        - start_cpu.user
+        - start_cpu.children_user
+    )
+    cpu_system = (
+        end_cpu.system
+        + end_cpu.children_system
+        - start_cpu.system
+        - start_cpu.children_system
+    )
+    if store is not None and not os.path.exists(store):
+        write_result(store, result)
+    return {
+        "query_time": query_time,
+        "total_time_cpu": cpu_user + cpu_system,
+        "cpu_user": cpu_user,
+        "cpu_system": cpu_system,
+        "rows": len(result) if hasattr(result, "__len__") else 1,
+        "rss_before": rss_before,
+        "peak_rss": peak_rss(),
+        # statistics the query collected itself, e.g. per shard times
+        **getattr(expr, "stats", {}),
+    }
 
 
-def profile_run(expression):
+def profile_run(
+    expression, memory_interval=0.05, cpus=None, spill_dir=None, store=None
+):
     start_time_process = timeit.default_timer()
-    start_time_cpu = time.process_time()
-    p = Process(target=execute, args=(expression,))
+    p = query_process(expression, cpus, store)
     p.start()
-    p.join()
-    if p.exception:
-        print("Excepted")
-    total_time_cpu = time.process_time() - start_time_cpu
+    spill = SpillSampler(spill_dir, memory_interval) if spill_dir else nullcontext()
+    with MemorySampler(p.pid, memory_interval) as memory, spill:
+        p.join()
     total_time_process = timeit.default_timer() - start_time_process
-    return total_time_process, total_time_cpu
+    if p.exception is not None:
+        error, tb = p.exception
+        print(tb, file=sys.stderr)
+        return {"failed": True, "error": error}
+    if p.result is None:
+        return {"failed": True, "error": f"query process exited with code {p.exitcode}"}
+    result = p.result
+    # the sampler can miss short spikes that the kernel's high water mark has
+    peak = max(memory.max_rss, result.pop("peak_rss"))
+    rss_before = result.pop("rss_before")
+    run = {
+        "failed": False,
+        "total_time_process": total_time_process,
+        **result,
+        "max_memory_usage": peak / MIB,
+        "incremental_memory_usage": (peak - rss_before) / MIB,
+        "max_uss": memory.max_uss / MIB,
+        "memory_samples": json.dumps(memory.series()),
+    }
+    if spill_dir:
+        # peak size of the spill directory, files are removed after the query
+        run["spilled_bytes"] = spill.max_size
+    return run
+
 
+def cache_mode(cold):
+    if cold is None:
+        return "none"
+    return "cold" if cold else "warm"
 
-def run_query(query, powermetrics, datadir, engine, threads=8, comment=""):
-    db = setup_tpch_db(datadir, engine, threads)
-    expression = QUERIES_TPCH[query](db)
+
+def measure_run(expression, powermetrics, datadir, cache="none", **run_options):
+    if cache == "cold":
+        evict(dataset_files(datadir))
     if powermetrics and is_powermetrics_available():
         with PowerMetricsProfiler() as power:
-            total_time_process, total_time_cpu = profile_run(expression)
+            run = profile_run(expression, **run_options)
         power_cpu = aggregate_power_stats(power.results)
     elif powermetrics and is_powercap_available():
         with PowercapRaplProfiler() as power:
-            total_time_process, total_time_cpu = profile_run(expression)
+            run = profile_run(expression, **run_options)
         power_cpu = {
             "cpu_mJ": power.results / 10**3,
             "power_mW": power.results / power.total_time / 10**3,
+            # every socket and its core, uncore and dram sub-domains
+            **{
+                f"{name.replace('/', '_')}_mJ": energy / 10**3
+                for name, energy in power.domains.items()
+            },
+            "energy_samples": json.dumps(power.series()),
         }
     else:
-        total_time_process, total_time_cpu = profile_run(expression)
+        run = profile_run(expression, **run_options)
         power_cpu = {}
+    if run["failed"]:
+        return run
+    return {**run, **power_cpu}
+
+
+def benchmark_expression(
+    expression,
+    powermetrics,
+    datadir,
+    cache="none",
+    warmups=1,
+    min_runs=1,
+    max_runs=1,
+    target_ci=0.05,
+    memory_interval=0.05,
+    cpus=None,
+    spill_dir=None,
+    store=None,
+):
+    key = lambda r: r["query_time"]
+    results = measure(
+        lambda: measure_run(
+            expression,
+            powermetrics,
+            datadir,
+            cache,
+            memory_interval=memory_interval,
+            cpus=cpus,
+            spill_dir=spill_dir,
+            store=store,
+        ),
+        key,
+        warmups=warmups if cache == "warm" else 0,
+        min_runs=min_runs,
+        max_runs=max_runs,
+        target_ci=target_ci,
+        failed=lambda r: r["failed"],
+    )
+    if results[-1]["failed"]:
+        return results[-1]
+    samples = [key(r) for r in results]
+    return {
+        **representative(results, key),
+        **summarize(samples),
+        "time_samples": json.dumps(samples),
+    }
+
 
-    run_stats = {
-        "name": query,
+def catalog_files(catalog, datadir, layout="flat"):
+    if catalog == "tpch":
+        # missing tables fail their rows, the fingerprint covers what exists
+        raw = datadir / "raw"
+        return [
+            f
+            for t in TPCH_TABLES
+            for f in dataset_files(raw / t) + [raw / f"{t}.parquet"]
+            if f.is_file()
+        ]
+    return [
+        f for t in FANNIE_TABLES for f in dataset_files(table_dir(datadir, t, layout))
+    ]
+
+
+def benchmark_cached(
+    expression, engine, files, result_cache=None, bypass_cache=False, **options
+):
+    if result_cache is None:
+        return benchmark_expression(expression, **options)
+    if bypass_cache:
+        return {**benchmark_expression(expression, **options), "result_cache": "bypass"}
+    key = result_cache.key(query_text(expression), engine, files)
+    result = result_cache.get(key)
+    if result is not None:
+        return {"failed": False, "rows": len(result), "result_cache": "hit"}
+    # the query process stores its result, the query is not run once more
+    store = str(result_cache.entry(key))
+    measured = benchmark_expression(expression, store=store, **options)
+    result_cache.evict()
+    return {**measured, "result_cache": "miss"}
+
+
+def profile_expression(db, expression, engine, name, profile_dir, top=TOP_OPERATORS):
+    if engine not in PROFILERS:
+        return {"profile_error": f"no operator profiler for {engine}"}
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    path = profile_dir / f"{name}-{stamp}.{EXTENSIONS[engine]}"
+    # profiling slows the engine down, so it gets its own untimed run
+    p = Process(target=profile_query, args=(db, expression, engine, path, top))
+    p.start()
+    p.join()
+    if p.exception is not None:
+        return {"profile_error": p.exception[0]}
+    if p.result is None:
+        return {"profile_error": f"profile process exited with code {p.exitcode}"}
+    return p.result
+
+
+def run_info(
+    name, threads, materialize, cache, memory_limit, comment, session=None, **extra
+):
+    return {
+        "name": name,
         "threads": threads,
+        **extra,
         "run_date": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-        "total_time_process": total_time_process,
-        "total_time_cpu": total_time_cpu,
+        "materialized": materialize,
+        "cache": cache,
+        "memory_limit": memory_limit,
+        "setup_time": session["setup_time"] if session else None,
+        "session_reused": session["queries"] > 0 if session else False,
         "comment": comment,
     }
-    run_stats.update(power_cpu)
+
+
+def setup_failed(error):
+    # an engine that cannot be set up does not abort the engines after it
+    print(traceback.format_exc(), file=sys.stderr)
+    return {"failed": True, "error": repr(error)}
+
+
+def run_query(
+    query,
+    powermetrics,
+    datadir,
+    engine,
+    threads=8,
+    comment="",
+    materialize=False,
+    cache="none",
+    profile_dir=None,
+    profile_top=TOP_OPERATORS,
+    memory_limit=None,
+    temp_dir=None,
+    result_cache=None,
+    bypass_cache=False,
+    **harness,
+):
+    if engine not in IBIS_ENGINES:
+        raise click.UsageError(f"the tpch queries are ibis expressions, {engine} cannot run them")
+    info = (query, threads, materialize, cache, memory_limit, comment)
+    cache_before = result_cache.stats if result_cache is not None else None
+    try:
+        session = get_session(
+            "tpch",
+            engine,
+            datadir,
+            threads,
+            materialize=materialize,
+            memory_limit=memory_limit,
+            temp_dir=temp_dir,
+        )
+    except Exception as e:
+        return {**run_info(*info), **setup_failed(e)}
+    expression = QUERIES_TPCH[query](session["db"])
+    measured = benchmark_cached(
+        expression,
+        engine,
+        catalog_files("tpch", datadir),
+        result_cache,
+        bypass_cache,
+        powermetrics=powermetrics,
+        datadir=datadir,
+        cache=cache,
+        spill_dir=temp_dir,
+        **harness,
+    )
+    if profile_dir is not None and not measured["failed"]:
+        name = f"{query}-{engine}-{threads}t"
+        measured.update(
+            profile_expression(
+                session["db"], expression, engine, name, profile_dir, profile_top
+            )
+        )
+
+    run_stats = run_info(*info, session)
+    session["queries"] += 1
+    run_stats.update(measured)
+    if result_cache is not None:
+        # the counters cover the whole invocation, a row gets its own lookups
+        run_stats.update(
+            {k: v - cache_before[k] for k, v in result_cache.stats.items()}
+        )
     return run_stats
 
 
-def run_query_fannie(powermetrics, datadir, engine, threads=8, comment=""):
-    db = BACKENDS.get(engine)
-    perf_path = datadir / "perf/*.parquet"
-    acq_path = datadir / "acq/*.parquet"
-    db.register(f"{perf_path}", "perf")
-    db.register(f"{acq_path}", "acq")
-    db.con.execute(f"PRAGMA threads={threads};")
-    expression = summary_query(db)
-    if powermetrics and is_powermetrics_available():
-        with PowerMetricsProfiler() as power:
-            total_time_process, total_time_cpu = profile_run(expression, db)
-        power_cpu = aggregate_power_stats(power.results)
-    elif powermetrics and is_powercap_available():
-        with PowercapRaplProfiler() as power:
-            total_time_process, total_time_cpu = profile_run(expression, db)
-        power_cpu = {
-            "cpu_mJ": power.results / 10**3,
-            "power_mW": power.results / power.total_time / 10**3,
+def run_stream(stream, queries, engine, datadir, threads, materialize, start):
+    # every stream has its own connection, set up before the streams start
+    try:
+        session = get_session("tpch", engine, datadir, threads, materialize=materialize)
+    except Exception:
+        start.abort()
+        raise
+    start.wait()
+    process = psutil.Process()
+    start_cpu = process.cpu_times()
+    executed = []
+    for position, query in enumerate(queries):
+        # building the expression is part of a query under contention
+        start_time = timeit.default_timer()
+        try:
+            QUERIES_TPCH[query](session["db"]).execute()
+            error = None
+        except Exception as e:
+            error = repr(e)
+        executed.append(
+            {
+                "stream": stream,
+                "position": position,
+                "name": query,
+                "latency": timeit.default_timer() - start_time,
+                "failed": error is not None,
+                "error": error,
+            }
+        )
+    end_cpu = process.cpu_times()
+    return {
+        # the monotonic clock is shared by the processes
+        "finished": time.monotonic(),
+        "queries": executed,
+        "cpu_time": end_cpu.user + end_cpu.system - start_cpu.user - start_cpu.system,
+        "setup_time": session["setup_time"],
+    }
+
+
+def run_throughput(queries, engine, datadir, threads, streams, materialize, seed):
+    if engine not in IBIS_ENGINES:
+        raise click.UsageError(f"the tpch queries are ibis expressions, {engine} cannot run them")
+    start = multiprocessing.Barrier(streams + 1)
+    processes = [
+        Process(
+            target=run_stream,
+            args=(stream, order, engine, datadir, threads, materialize, start),
+        )
+        for stream, order in enumerate(stream_orders(queries, streams, seed))
+    ]
+    for p in processes:
+        p.start()
+    try:
+        start.wait()
+    except threading.BrokenBarrierError:
+        pass
+    psutil.cpu_percent()
+    start_time = time.monotonic()
+    for p in processes:
+        p.join()
+    system_cpu = psutil.cpu_percent() / 100
+    errors = [p.exception for p in processes if p.exception is not None]
+    if errors:
+        for _, tb in errors:
+            print(tb, file=sys.stderr)
+        return [{"failed": True, "error": errors[0][0]}]
+    results = [p.result for p in processes]
+    # the streams' teardown is not part of the test
+    elapsed = max(r["finished"] for r in results) - start_time
+    rows = throughput(
+        [q for r in results for q in r["queries"]],
+        elapsed,
+        sum(r["cpu_time"] for r in results),
+        psutil.cpu_count(),
+    )
+    setup_time = max(r["setup_time"] for r in results)
+    return [
+        {
+            "failed": False,
+            **row,
+            "streams": streams,
+            "threads": threads,
+            "materialized": materialize,
+            "setup_time": setup_time,
+            "system_cpu_utilization": system_cpu,
+            "run_date": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
         }
+        for row in rows
+    ]
+
+
+def same_result(result, expected, keys):
+    result = result.sort_values(keys).reset_index(drop=True)
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_like=True)
+    except AssertionError:
+        return False
+    return True
+
+
+def matches_duckdb(expression, datadir, layout="flat", files=(), result_cache=None):
+    reference = get_session("fanniemae", "duckdb", datadir, layout=layout)
+    reference = summary_query(reference["db"])
+    if result_cache is None:
+        expected = reference.execute()
     else:
-        total_time_process, total_time_cpu = profile_run(expression, db)
-        power_cpu = {}
+        key = result_cache.key(query_text(reference), "duckdb", files)
+        expected = result_cache.execute(reference, key)
+    return same_result(expression.execute(), expected, ["year", "loan_age"])
 
-    run_stats = {
-        "name": "Summary",
-        "threads": threads,
-        "run_date": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-        "total_time_process": total_time_process,
-        "total_time_cpu": total_time_cpu,
-        "comment": comment
-    }
-    run_stats.update(power_cpu)
+
+def run_query_fannie(
+    powermetrics,
+    datadir,
+    engine,
+    threads=8,
+    comment="",
+    layout="flat",
+    materialize=False,
+    cache="none",
+    profile_dir=None,
+    profile_top=TOP_OPERATORS,
+    memory_limit=None,
+    temp_dir=None,
+    check_results=False,
+    result_cache=None,
+    bypass_cache=False,
+    shards=None,
+    scheduler=None,
+    **harness,
+):
+    applied_limit = memory_limit if engine in MEMORY_LIMIT_ENGINES else None
+    info = ("Summary", threads, materialize, cache, applied_limit, comment)
+    cache_before = result_cache.stats if result_cache is not None else None
+    try:
+        session = get_session(
+            "fanniemae",
+            engine,
+            datadir,
+            threads,
+            layout,
+            materialize,
+            memory_limit,
+            temp_dir,
+            shards,
+            scheduler,
+        )
+    except Exception as e:
+        return {**run_info(*info, layout=layout), **setup_failed(e)}
+    expression = SUMMARY_QUERIES.get(engine, summary_query)(session["db"])
+    files = catalog_files("fanniemae", datadir, layout)
+    measured = benchmark_cached(
+        expression,
+        engine,
+        files,
+        result_cache,
+        bypass_cache,
+        powermetrics=powermetrics,
+        datadir=datadir,
+        cache=cache,
+        spill_dir=temp_dir,
+        **harness,
+    )
+    if profile_dir is not None and not measured["failed"]:
+        name = f"summary-{engine}-{threads}t-{layout}"
+        measured.update(
+            profile_expression(
+                session["db"], expression, engine, name, profile_dir, profile_top
+            )
+        )
+    if check_results and not measured["failed"]:
+        measured["result_matches_duckdb"] = matches_duckdb(
+            expression, datadir, layout, files, result_cache
+        )
+
+    run_stats = run_info(*info, session, layout=layout)
+    session["queries"] += 1
+    run_stats.update(measured)
+    if result_cache is not None:
+        # the counters cover the whole invocation, a row gets its own lookups
+        run_stats.update(
+            {k: v - cache_before[k] for k, v in result_cache.stats.items()}
+        )
     return run_stats
 
 
+def harness_options(f):
+    f = click.option(
+        "--profile-top",
+        default=TOP_OPERATORS,
+        show_default=True,
+        help="Number of most expensive operators summarized per query",
+    )(f)
+    f = click.option(
+        "--profile-dir",
+        default=None,
+        help="Run every query once more with the engine's operator profiling "
+        "and store the profiles in this directory",
+    )(f)
+    f = click.option(
+        "--memory-interval",
+        default=0.05,
+        show_default=True,
+        help="Seconds between memory samples of the query process",
+    )(f)
+    f = click.option(
+        "--target-ci",
+        default=0.05,
+        show_default=True,
+        help="Stop repeating a query once the 95% confidence interval of its "
+        "run time is within this fraction of the mean",
+    )(f)
+    f = click.option(
+        "--max-runs",
+        default=1,
+        show_default=True,
+        help="Maximum number of measured runs per query",
+    )(f)
+    f = click.option(
+        "--min-runs",
+        default=1,
+        show_default=True,
+        help="Minimum number of measured runs per query",
+    )(f)
+    return f
+
+
+def spill_options(f):
+    f = click.option(
+        "--temp-dir",
+        default=None,
+        help="Directory the engines spill to, its peak size is recorded as "
+        "spilled_bytes",
+    )(f)
+    f = click.option(
+        "--memory-limit",
+        default=None,
+        help="Memory cap per engine e.g. 8GB, larger intermediates spill to disk. "
+        "Only duckdb and datafusion apply it, the other engines report none",
+    )(f)
+    return f
+
+
+def result_cache_options(f):
+    f = click.option(
+        "--bypass-result-cache/--use-result-cache",
+        default=False,
+        show_default=True,
+        help="Run every query and neither read nor store cached results, "
+        "for timing runs",
+    )(f)
+    f = click.option(
+        "--result-cache-size",
+        default="4GB",
+        show_default=True,
+        help="Size of the result cache, the least recently used results are "
+        "evicted beyond it",
+    )(f)
+    f = click.option(
+        "--result-cache",
+        default=None,
+        help="Directory of a result cache keyed by query, engine and input "
+        "files, queries with a cached result are not run again",
+    )(f)
+    return f
+
+
+def open_result_cache(path, size):
+    return ResultCache(path, parse_bytes(size)) if path is not None else None
+
+
+def results_options(f):
+    f = click.option(
+        "--label",
+        default=None,
+        help="Name of the stored run, run.py compare takes it in place of "
+        "the run id",
+    )(f)
+    f = click.option(
+        "--results-dir",
+        default=None,
+        help="Store the run with versions, git revision and dataset "
+        "fingerprint in this directory for run.py compare",
+    )(f)
+    return f
+
+
+def store_results(df, results_dir, benchmark, label=None, layout="flat"):
+    if results_dir is None:
+        return
+    fingerprints = {
+        d: dataset_fingerprint(catalog_files(benchmark, Path(d), layout))
+        for d in df.datadir.unique()
+    }
+    df = df.assign(dataset_fingerprint=df.datadir.map(fingerprints))
+    run_id = save_run(results_dir, df, benchmark, label, **platform_info())
+    click.echo(f"stored run {run_id} in {results_dir}", err=True)
+
+
 @click.group()
 def cli():
     pass
@@ -278,7 +1058,54 @@ def cli():
     show_default=True,
     help="comma seperated list of datadirs to run e.g. 2,4,8",
 )
-def tpch(datadir, powermetrics, engines, queries, threads, comment, repeat):
+@click.option(
+    "--materialize/--no-materialize",
+    default=False,
+    show_default=True,
+    help="Load tables into the engine's native storage once before querying",
+)
+@click.option(
+    "--cold/--warm",
+    default=None,
+    help="cold evicts the dataset files from the page cache before every run, "
+    "warm runs discarded warm-up iterations first  [default: neither]",
+)
+@click.option(
+    "--warmups",
+    default=1,
+    show_default=True,
+    help="Number of discarded warm-up runs in warm mode",
+)
+@harness_options
+@spill_options
+@result_cache_options
+@results_options
+def tpch(
+    datadir,
+    powermetrics,
+    engines,
+    queries,
+    threads,
+    comment,
+    repeat,
+    materialize,
+    cold,
+    warmups,
+    min_runs,
+    max_runs,
+    target_ci,
+    memory_interval,
+    profile_dir,
+    profile_top,
+    memory_limit,
+    temp_dir,
+    result_cache,
+    result_cache_size,
+    bypass_result_cache,
+    results_dir,
+    label,
+):
+    result_cache = open_result_cache(result_cache, result_cache_size)
     datadirs = [s for s in datadir.split(",")]
     engines = [s for s in engines.split(",")]
     queries = [s for s in queries.split(",")]
@@ -288,7 +1115,28 @@ def tpch(datadir, powermetrics, engines, queries, threads, comment, repeat):
         for datadir, engine, thread in itertools.product(datadirs, engines, threads):
             datadir = Path(datadir)
             stats = [
-                run_query(query, powermetrics, datadir, engine, thread, comment) for query in queries
+                run_query(
+                    query,
+                    powermetrics,
+                    datadir,
+                    engine,
+                    thread,
+                    comment,
+                    materialize=materialize,
+                    cache=cache_mode(cold),
+                    warmups=warmups,
+                    min_runs=min_runs,
+                    max_runs=max_runs,
+                    target_ci=target_ci,
+                    memory_interval=memory_interval,
+                    profile_dir=profile_dir,
+                    profile_top=profile_top,
+                    memory_limit=memory_limit,
+                    temp_dir=temp_dir,
+                    result_cache=result_cache,
+                    bypass_cache=bypass_result_cache,
+                )
+                for query in queries
             ]
 
             data = {**platform_info(), "runs": stats, "datadir": datadir, "db": engine, "runno": runno}
@@ -296,6 +1144,7 @@ def tpch(datadir, powermetrics, engines, queries, threads, comment, repeat):
 
     df = pd.json_normalize(runs, ["runs"], meta=["datadir", "db", "runno"])
     click.echo(df.to_csv(index=False))
+    store_results(df, results_dir, "tpch", label)
 
 
 @click.command()
@@ -323,23 +1172,370 @@ def tpch(datadir, powermetrics, engines, queries, threads, comment, repeat):
     show_default=True,
     help="comma seperated list of datadirs to run e.g. 2,4,8",
 )
-def fanniemae(datadir, powermetrics, engines, threads):
+@click.option(
+    "--layout",
+    type=click.Choice(LAYOUTS),
+    default="flat",
+    show_default=True,
+    help="parquet layout written by prepare.py",
+)
+@click.option(
+    "--materialize/--no-materialize",
+    default=False,
+    show_default=True,
+    help="Load tables into the engine's native storage once before querying",
+)
+@click.option(
+    "--cold/--warm",
+    default=None,
+    help="cold evicts the dataset files from the page cache before every run, "
+    "warm runs discarded warm-up iterations first  [default: neither]",
+)
+@click.option(
+    "--warmups",
+    default=1,
+    show_default=True,
+    help="Number of discarded warm-up runs in warm mode",
+)
+@click.option(
+    "--check-results/--no-check-results",
+    default=False,
+    show_default=True,
+    help="Compare every engine's summary with the duckdb result",
+)
+@click.option(
+    "--shards",
+    default=None,
+    type=int,
+    help="Number of shards the perf files are split into by the dask engine  "
+    "[default: cpu count]",
+)
+@click.option(
+    "--scheduler",
+    default=None,
+    help="Address of a dask distributed scheduler for the dask engine, "
+    "local worker processes otherwise",
+)
+@harness_options
+@spill_options
+@result_cache_options
+@results_options
+def fanniemae(
+    datadir,
+    powermetrics,
+    engines,
+    threads,
+    layout,
+    materialize,
+    cold,
+    warmups,
+    min_runs,
+    max_runs,
+    target_ci,
+    memory_interval,
+    profile_dir,
+    profile_top,
+    memory_limit,
+    temp_dir,
+    check_results,
+    shards,
+    scheduler,
+    result_cache,
+    result_cache_size,
+    bypass_result_cache,
+    results_dir,
+    label,
+):
+    result_cache = open_result_cache(result_cache, result_cache_size)
     datadirs = [s for s in datadir.split(",")]
     engines = [s for s in engines.split(",")]
-    threads = [s for s in threads.split(",")]
+    threads = [int(s) for s in threads.split(",")]
     runs = []
     for datadir, engine, thread in itertools.product(datadirs, engines, threads):
         datadir = Path(datadir)
-        stats = [run_query_fannie(powermetrics, datadir, engine, thread)]
+        stats = [
+            run_query_fannie(
+                powermetrics,
+                datadir,
+                engine,
+                thread,
+                layout=layout,
+                materialize=materialize,
+                cache=cache_mode(cold),
+                warmups=warmups,
+                min_runs=min_runs,
+                max_runs=max_runs,
+                target_ci=target_ci,
+                memory_interval=memory_interval,
+                profile_dir=profile_dir,
+                profile_top=profile_top,
+                memory_limit=memory_limit,
+                temp_dir=temp_dir,
+                check_results=check_results,
+                result_cache=result_cache,
+                bypass_cache=bypass_result_cache,
+                shards=shards,
+                scheduler=scheduler,
+            )
+        ]
         data = {**platform_info(), "runs": stats, "datadir": datadir, "db": engine}
         runs.append(data)
 
     df = pd.json_normalize(runs, ["runs"], meta=["datadir", "db"])
     click.echo(df.to_csv(index=False))
+    store_results(df, results_dir, "fanniemae", label, layout)
+
+
+@click.command(name="thread-scaling")
+@click.option(
+    "--benchmark",
+    type=click.Choice(["tpch", "fanniemae"]),
+    default="fanniemae",
+    show_default=True,
+    help="which queries to sweep",
+)
+@click.option(
+    "--queries",
+    default=",".join(QUERIES_TPCH),
+    show_default=True,
+    help="comma seperated list of tpch questions to run",
+)
+@click.option(
+    "--engines",
+    default="duckdb",
+    show_default=True,
+    help="comma seperated list of engines to run e.g. duckdb,datafusion",
+)
+@click.option(
+    "--datadir",
+    default="data",
+    show_default=True,
+    help="comma seperated list of datadirs to run",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(LAYOUTS),
+    default="flat",
+    show_default=True,
+    help="parquet layout written by prepare.py, fanniemae only",
+)
+@click.option(
+    "--threads",
+    default=None,
+    help="comma seperated list of thread counts, 1 is always included as the "
+    "baseline  [default: 1, powers of two and the cpu count]",
+)
+@click.option(
+    "--pin/--no-pin",
+    default=False,
+    show_default=True,
+    help="Pin the query process to as many cpus as it has threads (Linux only)",
+)
+@harness_options
+@spill_options
+def thread_scaling_sweep(
+    benchmark, queries, engines, datadir, layout, threads, pin, **harness
+):
+    if pin and not hasattr(os, "sched_setaffinity"):
+        raise click.UsageError("--pin needs os.sched_setaffinity, which is Linux only")
+    datadirs = [s for s in datadir.split(",")]
+    engines = [s for s in engines.split(",")]
+    queries = [s for s in queries.split(",")]
+    if threads is None:
+        threads = thread_counts(psutil.cpu_count())
+    else:
+        threads = sorted({1} | {int(s) for s in threads.split(",")})
+    cpus = sorted(os.sched_getaffinity(0)) if pin else None
+    runs = []
+    for datadir, engine, thread in itertools.product(datadirs, engines, threads):
+        datadir = Path(datadir)
+        pinned = set(cpus[:thread]) if pin else None
+        if benchmark == "tpch":
+            stats = [
+                run_query(query, False, datadir, engine, thread, cpus=pinned, **harness)
+                for query in queries
+            ]
+        else:
+            stats = [
+                run_query_fannie(
+                    False, datadir, engine, thread, layout=layout, cpus=pinned, **harness
+                )
+            ]
+        runs.append({**platform_info(), "runs": stats, "datadir": datadir, "db": engine})
+
+    df = pd.json_normalize(runs, ["runs"], meta=["datadir", "db"])
+    click.echo(thread_scaling(df).to_csv(index=False))
+
+
+@click.command(name="data-scaling")
+@click.option(
+    "--engines",
+    default="duckdb",
+    show_default=True,
+    help="comma seperated list of engines to run e.g. duckdb,datafusion",
+)
+@click.option(
+    "--datadir",
+    default="data",
+    show_default=True,
+    help="comma seperated list of datadirs prepared with different --years",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(LAYOUTS),
+    default="flat",
+    show_default=True,
+    help="parquet layout written by prepare.py",
+)
+@click.option(
+    "--threads",
+    default=8,
+    show_default=True,
+    help="Number of threads per engine",
+)
+@harness_options
+@spill_options
+def data_scaling_sweep(engines, datadir, layout, threads, **harness):
+    datadirs = [Path(s) for s in datadir.split(",")]
+    engines = [s for s in engines.split(",")]
+    sizes = {d: dataset_size(d, FANNIE_TABLES, layout) for d in datadirs}
+    runs = []
+    for datadir, engine in itertools.product(datadirs, engines):
+        stats = [
+            {
+                **run_query_fannie(
+                    False, datadir, engine, threads, layout=layout, **harness
+                ),
+                **sizes[datadir],
+            }
+        ]
+        runs.append({**platform_info(), "runs": stats, "datadir": datadir, "db": engine})
+
+    df = pd.json_normalize(runs, ["runs"], meta=["datadir", "db"])
+    click.echo(data_scaling(df).to_csv(index=False))
+
+
+@click.command(name="throughput")
+@click.option(
+    "--streams",
+    default="2",
+    show_default=True,
+    help="comma seperated list of numbers of concurrent query streams",
+)
+@click.option(
+    "--queries",
+    default=",".join(QUERIES_TPCH),
+    show_default=True,
+    help="comma seperated list of queries every stream runs once",
+)
+@click.option(
+    "--engines",
+    default="duckdb",
+    show_default=True,
+    help="comma seperated list of engines to run e.g. duckdb,datafusion",
+)
+@click.option(
+    "--datadir",
+    default="data",
+    show_default=True,
+    help="comma seperated list of datadirs to run",
+)
+@click.option(
+    "--threads",
+    default=8,
+    show_default=True,
+    help="Number of threads of every stream's connection",
+)
+@click.option(
+    "--materialize/--no-materialize",
+    default=False,
+    show_default=True,
+    help="Load tables into the engine's native storage before the streams start",
+)
+@click.option(
+    "--seed",
+    default=0,
+    show_default=True,
+    help="Seed of the query order permutations, the first stream keeps the "
+    "given order",
+)
+def throughput_test(streams, queries, engines, datadir, threads, materialize, seed):
+    datadirs = [s for s in datadir.split(",")]
+    engines = [s for s in engines.split(",")]
+    queries = [s for s in queries.split(",")]
+    streams = [int(s) for s in streams.split(",")]
+    runs = []
+    for datadir, engine, stream_count in itertools.product(datadirs, engines, streams):
+        stats = run_throughput(
+            queries, engine, Path(datadir), threads, stream_count, materialize, seed
+        )
+        runs.append({**platform_info(), "runs": stats, "datadir": datadir, "db": engine})
+
+    df = pd.json_normalize(runs, ["runs"], meta=["datadir", "db"])
+    click.echo(df.to_csv(index=False))
+
+
+@click.command()
+@click.argument("baseline")
+@click.argument("candidate")
+@click.option(
+    "--results-dir",
+    required=True,
+    help="Directory the runs were stored in with --results-dir",
+)
+@click.option(
+    "--alpha",
+    default=0.05,
+    show_default=True,
+    help="Significance level of the test for slower run times",
+)
+@click.option(
+    "--threshold",
+    default=0.05,
+    show_default=True,
+    help="Smallest relative slowdown that is flagged",
+)
+@click.option(
+    "--memory-threshold",
+    default=0.10,
+    show_default=True,
+    help="Smallest relative growth of peak memory that is flagged",
+)
+@click.option(
+    "--fail-on-regression/--no-fail-on-regression",
+    default=False,
+    show_default=True,
+    help="Exit with status 1 when a slowdown or memory growth is flagged",
+)
+def compare(
+    baseline,
+    candidate,
+    results_dir,
+    alpha,
+    threshold,
+    memory_threshold,
+    fail_on_regression,
+):
+    """Compare the queries of the stored runs BASELINE and CANDIDATE, given as
+    run ids or labels."""
+    history = load_runs(results_dir)
+    try:
+        baseline = select_run(history, baseline)
+        candidate = select_run(history, candidate)
+    except KeyError as e:
+        raise click.UsageError(e.args[0])
+    df = compare_runs(baseline, candidate, alpha, threshold, memory_threshold)
+    click.echo(df.to_csv(index=False))
+    if fail_on_regression and (df.slowdown | df.memory_growth).any():
+        sys.exit(1)
 
 
 cli.add_command(tpch)
 cli.add_command(fanniemae)
+cli.add_command(thread_scaling_sweep)
+cli.add_command(data_scaling_sweep)
+cli.add_command(throughput_test)
+cli.add_command(compare)
 
 if __name__ == "__main__":
     cli()
@@ -1,21 +1,199 @@
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
 import duckdb
-import pyarrow.parquet as pq
-import pyarrow.compute as pac
 import pyarrow as pa
+import pyarrow.parquet as pq
+
+# the tables dbgen splits into chunks, nation and region are the same at
+# every scale factor
+SCALED_TABLES = ["customer", "lineitem", "orders", "part", "partsupp", "supplier"]
+FIXED_TABLES = ["nation", "region"]
+COMPRESSIONS = ["snappy", "zstd", "gzip", "lz4", "brotli", "none"]
+
+
+def float_schema(schema):
+    # the benchmark queries expect doubles, not decimals
+    return pa.schema(
+        [
+            pa.field(f.name, pa.float64()) if pa.types.is_decimal(f.type) else f
+            for f in schema
+        ]
+    )
+
+
+def load_tpch(con):
+    try:
+        con.execute("LOAD tpch")
+    except duckdb.Error:
+        # builds that do not bundle the extension download it once
+        con.execute("INSTALL tpch; LOAD tpch")
+
+
+def supports_children():
+    # older duckdb releases cannot generate a chunk of the data
+    con = duckdb.connect()
+    load_tpch(con)
+    try:
+        con.execute("CALL dbgen(sf=0, children=2, step=0)")
+    except duckdb.BinderException:
+        return False
+    finally:
+        con.close()
+    return True
+
+
+def write_table(con, table, path, row_group_size, **parquet_options):
+    reader = con.execute(f"SELECT * FROM {table}").fetch_record_batch(row_group_size)
+    schema = float_schema(reader.schema)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = 0
+    with pq.ParquetWriter(path, schema, **parquet_options) as writer:
+        # duckdb hands out smaller batches, they are gathered into full row
+        # groups and only the last one is shorter
+        pending = pa.Table.from_batches([], reader.schema)
+        for batch in reader:
+            pending = pa.concat_tables([pending, pa.Table.from_batches([batch])])
+            full = pending.num_rows - pending.num_rows % row_group_size
+            if full:
+                writer.write_table(
+                    pending.slice(0, full).cast(schema), row_group_size=row_group_size
+                )
+                pending = pending.slice(full)
+            rows += batch.num_rows
+        if pending.num_rows:
+            writer.write_table(pending.cast(schema))
+    return rows
+
 
-con = duckdb.connect()
-con.execute("INSTALL tpch; LOAD tpch")
-con.execute("CALL dbgen(sf=100)")
+def generate_chunk(
+    outdir, tables, scale_factor, children, step, row_group_size, **parquet_options
+):
+    """Generate step ``step`` of ``children`` into a database file, so the
+    chunk does not have to fit in memory, and write its tables as
+    ``<outdir>/<table>/part-<step>.parquet``."""
+    with tempfile.TemporaryDirectory(dir=outdir) as tmp:
+        con = duckdb.connect(str(Path(tmp) / "dbgen.duckdb"))
+        load_tpch(con)
+        if children > 1:
+            con.execute(
+                f"CALL dbgen(sf={scale_factor}, children={children}, step={step})"
+            )
+        else:
+            con.execute(f"CALL dbgen(sf={scale_factor})")
+        rows = {
+            table: write_table(
+                con,
+                table,
+                outdir / table / f"part-{step:05d}.parquet",
+                row_group_size,
+                **parquet_options,
+            )
+            for table in tables
+        }
+        con.close()
+    return rows
 
-tables =["customer", "lineitem", "nation", "orders", "part", "partsupp", "region", "supplier"]
 
-for t in tables:
-    parquet_table = con.query(f"SELECT * FROM {t}").arrow()
-    for i, (col_name, type_) in enumerate(zip(parquet_table.schema.names, parquet_table.schema.types)):
-      if pa.types.is_decimal(type_):
-        parquet_table = parquet_table.set_column(i, col_name, pac.cast(parquet_table.column(col_name), pa.float64()))
-        pq.write_table(parquet_table,f"sf100/{t}.parquet")
-      else:
-          pq.write_table(parquet_table, f"sf100/{t}.parquet")
+@click.command()
+@click.option(
+    "--scale-factor",
+    type=float,
+    default=1,
+    show_default=True,
+    help="TPC-H scale factor, 1 is about 1GB of data",
+)
+@click.option(
+    "--datadir",
+    default="data",
+    show_default=True,
+    help="directory whose raw/<table>/ directories run.py tpch reads",
+)
+@click.option(
+    "--children",
+    type=int,
+    default=None,
+    help="Number of chunks dbgen splits the data into, one parquet file per "
+    "table and chunk, 1 with a duckdb that cannot split it  [default: the "
+    "scale factor rounded up]",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of chunks generated in parallel  [default: cpu count]",
+)
+@click.option(
+    "--row-group-size",
+    type=int,
+    default=1 << 20,
+    show_default=True,
+    help="Number of rows per parquet row group, also the batch size streamed "
+    "out of duckdb",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(COMPRESSIONS),
+    default="snappy",
+    show_default=True,
+    help="Parquet compression codec",
+)
+def main(scale_factor, datadir, children, workers, row_group_size, compression):
+    outdir = Path(datadir) / "raw"
+    for table in SCALED_TABLES + FIXED_TABLES:
+        # parts of an earlier run with more children would be read as well,
+        # and a single file of the old layout instead of the new data
+        shutil.rmtree(outdir / table, ignore_errors=True)
+        (outdir / f"{table}.parquet").unlink(missing_ok=True)
+    outdir.mkdir(parents=True, exist_ok=True)
+    children = children or max(math.ceil(scale_factor), 1)
+    if children > 1 and not supports_children():
+        click.echo(
+            f"warning: dbgen of duckdb {duckdb.__version__} cannot split the data "
+            "into chunks, it is generated as one",
+            err=True,
+        )
+        children = 1
+    options = {"compression": compression}
+    with ProcessPoolExecutor(workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                generate_chunk,
+                outdir,
+                SCALED_TABLES,
+                scale_factor,
+                children,
+                step,
+                row_group_size,
+                **options,
+            )
+            for step in range(children)
+        ]
+        # the smallest scale factor is enough for the fixed tables
+        futures.append(
+            executor.submit(
+                generate_chunk,
+                outdir,
+                FIXED_TABLES,
+                0.01,
+                1,
+                0,
+                row_group_size,
+                **options,
+            )
+        )
+        rows = {}
+        for future in futures:
+            for table, count in future.result().items():
+                rows[table] = rows.get(table, 0) + count
+    for table, count in sorted(rows.items()):
+        click.echo(f"{table}: {count} rows in {outdir / table}")
 
 
+if __name__ == "__main__":
+    main()